@@ -0,0 +1,35 @@
+{#
+  Filter for incremental staging runs: source months (year, month) that were
+  cleaned after the last build, every month if vehicle_emissions was reloaded
+  since then, plus any months forced with
+  --vars '{refresh_partitions: ["2024-01", "2024-02"]}'.
+#}
+{% macro changed_partitions(dataset) %}
+    (
+        (src.year, src.month) in (
+            select year, month
+            from {{ source('taxi_data', 'ingest_manifest') }}
+            where dataset = '{{ dataset }}'
+              and cleaned_at > (select coalesce(max(built_at), timestamp '1900-01-01') from {{ this }})
+        )
+        or (
+            select max(loaded_at)
+            from {{ source('taxi_data', 'ingest_manifest') }}
+            where dataset = 'emissions'
+        ) > (select coalesce(max(built_at), timestamp '1900-01-01') from {{ this }})
+        {% for ym in var('refresh_partitions', []) %}
+        or (src.year = {{ ym[:4] | int }} and src.month = {{ ym[5:7] | int }})
+        {% endfor %}
+    )
+{% endmacro %}
+
+{#
+  The same filter for models over fct_trips_co2 (aliased src), which hold
+  both taxi types.
+#}
+{% macro changed_trip_partitions() %}
+    (
+        (src.taxi_type = 'yellow' and {{ changed_partitions('yellow') }})
+        or (src.taxi_type = 'green' and {{ changed_partitions('green') }})
+    )
+{% endmacro %}
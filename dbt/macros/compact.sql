@@ -0,0 +1,21 @@
+{#
+  Casts expr to the compact schema's type for column_name when the compact_schema
+  var is set, and to the default type otherwise. Types mirror WIDE_TYPES and
+  COMPACT_TYPES in scripts/config.py.
+#}
+{% macro compact(expr, column_name) %}
+    {%- set wide = {
+        'passenger_count': 'integer', 'trip_distance': 'double',
+        'taxi_type': 'varchar', 'vehicle_type': 'varchar',
+        'hour_of_day': 'bigint', 'day_of_week': 'bigint', 'week_of_year': 'bigint', 'month_of_year': 'bigint',
+        'trip_hours': 'double', 'avg_mph': 'double', 'trip_co2_kgs': 'double'
+    } -%}
+    {%- set narrow = {
+        'passenger_count': 'smallint', 'trip_distance': 'float',
+        'taxi_type': "enum('yellow', 'green')", 'vehicle_type': "enum('yellow_taxi', 'green_taxi')",
+        'hour_of_day': 'tinyint', 'day_of_week': 'tinyint', 'week_of_year': 'tinyint', 'month_of_year': 'tinyint',
+        'trip_hours': 'float', 'avg_mph': 'float', 'trip_co2_kgs': 'float'
+    } -%}
+    {%- set types = narrow if var('compact_schema', false) else wide -%}
+    cast({{ expr }} as {{ types[column_name] }})
+{%- endmacro %}
@@ -0,0 +1,15 @@
+{#
+  on-run-end hook: one dbt_runs row per model built successfully, so readers
+  (scripts/result_cache.py) can tell when a model last changed from a lookup
+  instead of scanning it. DBT_RUNS_TABLE in scripts/config.py.
+#}
+{% macro record_dbt_run(results) %}
+    create table if not exists dbt_runs (
+        invocation_id varchar,
+        model varchar,
+        finished_at timestamp
+    );
+    {% for res in results if res.node.resource_type == 'model' and res.status == 'success' %}
+    insert into dbt_runs values ('{{ invocation_id }}', '{{ res.node.name }}', now()::timestamp);
+    {% endfor %}
+{% endmacro %}
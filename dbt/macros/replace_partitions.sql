@@ -0,0 +1,22 @@
+{#
+  Custom incremental strategy: drop every target row whose unique_key values
+  appear in the new batch, then append the batch. Unlike the built-in
+  delete+insert (a DELETE ... USING join that matches each target row against
+  every batch row with the same key), this deletes with one IN (...) lookup
+  against the distinct keys, so replacing a month costs one pass.
+#}
+{% macro get_incremental_replace_partitions_sql(arg_dict) %}
+    {%- set target = arg_dict["target_relation"] -%}
+    {%- set source = arg_dict["temp_relation"] -%}
+    {%- set unique_key = arg_dict["unique_key"] -%}
+    {%- set keys = [unique_key] if unique_key is string else unique_key -%}
+    {%- set dest_cols_csv = get_quoted_csv(arg_dict["dest_columns"] | map(attribute="name")) -%}
+
+    delete from {{ target }}
+    where ({{ keys | join(', ') }}) in (
+        select distinct {{ keys | join(', ') }} from {{ source }}
+    );
+
+    insert into {{ target }} ({{ dest_cols_csv }})
+    select {{ dest_cols_csv }} from {{ source }}
+{% endmacro %}
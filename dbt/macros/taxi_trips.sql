@@ -0,0 +1,22 @@
+{#
+  Normalized trips for one taxi type: the same columns for yellow and green,
+  with the taxi-specific pickup/dropoff column names mapped to pickup_time and
+  dropoff_time. Incremental runs only read the changed source months. Column
+  types follow the compact_schema var (macros/compact.sql).
+#}
+{% macro taxi_trips(taxi_type, pickup_col, dropoff_col) %}
+    select
+        {{ compact("'" ~ taxi_type ~ "'", 'taxi_type') }} as taxi_type,
+        {{ compact("'" ~ taxi_type ~ "_taxi'", 'vehicle_type') }} as vehicle_type,
+        src.{{ pickup_col }} as pickup_time,
+        src.{{ dropoff_col }} as dropoff_time,
+        {{ compact('src.passenger_count', 'passenger_count') }} as passenger_count,
+        {{ compact('src.trip_distance', 'trip_distance') }} as trip_distance,
+        src.source_file,
+        src.year,
+        src.month
+    from {{ source('taxi_data', taxi_type ~ '_taxi_trips') }} as src
+    {% if is_incremental() %}
+    where {{ changed_partitions(taxi_type) }}
+    {% endif %}
+{% endmacro %}
@@ -0,0 +1,33 @@
+{{ config(
+    materialized = 'incremental',
+    incremental_strategy = 'replace_partitions',
+    unique_key = ['taxi_type', 'year', 'month']
+) }}
+
+/* Compact CO2 rollup: one row per taxi type, source month and pickup year/month/week/day/hour.
+   Keeps counts, sums, min and max so averages can be derived exactly
+   (e.g. sum(co2_kgs_sum) / sum(trip_count)) without touching the trip tables. built_at is the newest source row's build time,
+   which the analysis result cache uses as a version stamp.
+   Incremental by source month like fct_trips_co2: a run only re-aggregates the months it rebuilt. */
+select
+    taxi_type,
+    year,
+    month,
+    extract(year from pickup_time) as pickup_year,
+    month_of_year,
+    week_of_year,
+    day_of_week,
+    hour_of_day,
+    count(*) as trip_count,
+    sum(trip_co2_kgs) as co2_kgs_sum,
+    min(trip_co2_kgs) as co2_kgs_min,
+    max(trip_co2_kgs) as co2_kgs_max,
+    sum(trip_distance) as distance_sum,
+    sum(trip_hours) as trip_hours_sum,
+    max(built_at) as built_at
+from {{ ref('fct_trips_co2') }} as src
+{% if is_incremental() %}
+where {{ changed_trip_partitions() }}
+{% endif %}
+group by all
+order by taxi_type, year, month, pickup_year, month_of_year, week_of_year, day_of_week, hour_of_day
@@ -0,0 +1,37 @@
+{{ config(
+    materialized = ('view' if var('storage_mode', 'duckdb') == 'lake' else 'incremental'),
+    incremental_strategy = 'replace_partitions',
+    unique_key = ['taxi_type', 'year', 'month']
+) }}
+
+with trips as (
+    {{ taxi_trips('yellow', 'tpep_pickup_datetime', 'tpep_dropoff_datetime') }}
+    union all
+    {{ taxi_trips('green', 'lpep_pickup_datetime', 'lpep_dropoff_datetime') }}
+),
+emissions as (
+    select
+        lower(vehicle_type) as vehicle_type,
+        co2_grams_per_mile
+    from {{ source('taxi_data','vehicle_emissions') }}
+)
+select
+    trips.*,
+    /* get duration in hrs */
+    {{ compact('extract(epoch from (dropoff_time - pickup_time)) / 3600.0', 'trip_hours') }} as trip_hours,
+    /* avg mph */
+    {{ compact('trip_distance / (extract(epoch from (dropoff_time - pickup_time)) / 3600.0)', 'avg_mph') }} as avg_mph,
+    /* time extractions */
+    {{ compact('extract(hour from pickup_time)', 'hour_of_day') }} as hour_of_day,
+    {{ compact('extract(dow from pickup_time)', 'day_of_week') }} as day_of_week,
+    {{ compact('extract(week from pickup_time)', 'week_of_year') }} as week_of_year,
+    {{ compact('extract(month from pickup_time)', 'month_of_year') }} as month_of_year,
+    /* co2 calc, one join on the normalized vehicle type */
+    {{ compact('(coalesce(trip_distance,0.0) * coalesce(e.co2_grams_per_mile,0.0)) / 1000.0', 'trip_co2_kgs') }} as trip_co2_kgs,
+    /* build time, used to find partitions cleaned since the last run */
+    current_timestamp::timestamp as built_at
+from trips
+left join emissions e
+  on trips.vehicle_type = e.vehicle_type
+/* sorted so DuckDB's per-row-group min/max (zone maps) can skip row groups on time filters */
+order by pickup_time
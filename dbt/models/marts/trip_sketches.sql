@@ -0,0 +1,59 @@
+{{ config(
+    materialized = 'incremental',
+    incremental_strategy = 'replace_partitions',
+    unique_key = ['taxi_type', 'year', 'month']
+) }}
+
+/* Mergeable distribution sketches of trip_co2_kgs, avg_mph and trip_hours: for each source month
+   (taxi_type, year, month), pickup year/month/hour and metric, a histogram over logarithmic bins.
+   Bin i holds values in (gamma^(i-1), gamma^i], so any value read back from it is within
+   sketch_relative_accuracy of the truth (DDSketch); values <= 0 share the NULL bin.
+   Histograms merge by summing trip_count per bin, so quantiles over any months, hours or
+   taxi types come from this table alone (scripts/analysis.py quantiles()).
+   Only source months cleaned since the last run are re-sketched (changed_trip_partitions, as for
+   co2_rollup), and all of them when the accuracy var changes. */
+{%- set accuracy = var('sketch_relative_accuracy', 0.01) -%}
+{%- set gamma = 'cast(' ~ ((1 + accuracy) / (1 - accuracy)) ~ ' as double)' %}
+
+with trips as (
+    select
+        taxi_type,
+        year,
+        month,
+        extract(year from pickup_time) as pickup_year,
+        month_of_year,
+        hour_of_day,
+        cast(trip_co2_kgs as double) as trip_co2_kgs,
+        cast(avg_mph as double) as avg_mph,
+        cast(trip_hours as double) as trip_hours,
+        built_at
+    from {{ ref('fct_trips_co2') }} as src
+    {% if is_incremental() %}
+    where {{ changed_trip_partitions() }}
+       or (select max(gamma) from {{ this }}) is distinct from {{ gamma }}
+    {% endif %}
+),
+metric_values as (
+    /* one row per trip and metric; unpivot drops NULLs */
+    unpivot trips on trip_co2_kgs, avg_mph, trip_hours into name metric value metric_value
+)
+select
+    taxi_type,
+    year,
+    month,
+    pickup_year,
+    month_of_year,
+    hour_of_day,
+    metric,
+    case when metric_value > 0 then cast(ceil(ln(metric_value) / ln({{ gamma }})) as integer) end as bin,
+    count(*) as trip_count,
+    /* exact bounds per bin: estimates are clamped to the values actually seen */
+    min(metric_value) as value_min,
+    max(metric_value) as value_max,
+    {{ gamma }} as gamma,
+    max(built_at) as built_at
+from metric_values
+/* zero-duration trips have an infinite avg_mph */
+where isfinite(metric_value)
+group by all
+order by taxi_type, year, month, metric, pickup_year, month_of_year, hour_of_day, bin
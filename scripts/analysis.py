@@ -1,15 +1,51 @@
 import duckdb
+import argparse
 import logging
-import pandas as pd 
-import matplotlib.pyplot as plt 
-import matplotlib.dates as mdates
-from matplotlib.ticker import FuncFormatter, LogLocator, MultipleLocator
+import re
+from contextlib import contextmanager
+from statistics import NormalDist
+from dataclasses import dataclass, field
+from pathlib import Path
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import instrument
+import parallel
+import query
+import result_cache
+import series
+import snapshot
+from config import DB_PATH, YEARS, TAXIS, FCT_TRIPS, CO2_ROLLUP, TRIP_SKETCHES
 
 # Configs
-DB_PATH = "taxi.duckdb"
+TAXI_LABELS = {"yellow": "YELLOW", "green": "GREEN"}
 
-STG_YELLOW = "stg_yellow"
-STG_GREEN  = "stg_green"
+USE_ROLLUP = True # answer from the dbt rollup model when it exists instead of scanning trips
+READ_SNAPSHOT = True # read the latest published snapshot (snapshot.py) instead of the working database
+PLOT_PATH = "co2_by_year.png"
+PLOTS = {"year": PLOT_PATH, "month": "co2_by_month.png"} # grain -> chart rendered from the series store
+
+ANALYSIS_THREADS = None # DuckDB threads for analysis queries, None = one per core
+ANALYSIS_MEMORY_LIMIT = None # None = DuckDB default
+ANALYSIS_TEMP_DIRECTORY = None # where spills go, None = DuckDB's default next to the database
+
+# Sampled mode: answer from a sample of trips with confidence intervals instead of exact averages
+SAMPLE = None # None = exact, or e.g. "1%" / "500000 ROWS"
+SAMPLE_METHOD = "bernoulli" # "bernoulli"/"reservoir" sample rows; "system" samples whole vectors (faster, but
+                            # trips are clustered by time, so the intervals come out too narrow)
+SAMPLE_SEED = 42 # fixed so repeated runs (and the result cache) see the same sample
+CONFIDENCE = 0.95
+FLIPS_SHOWN = 3 # rivals listed per possibly-flipped ranking
+
+EXPORT_BATCH_ROWS = 1_000_000 # rows per Arrow record batch when streaming extracts
+
+TOP_K = 10 # trips kept per taxi type and bucket by top_trips()
+# Bucket -> expression over the fact model; day/week/month/year match the series store's periods
+TOP_BUCKETS = {**{grain: expr for grain, (expr, _, _, _) in series.GRAINS.items()}, "hour": "hour_of_day"}
+
+QUANTILES = [0.5, 0.95, 0.99] # read from the trip_sketches histograms by quantiles()
+SKETCH_METRICS = ["trip_co2_kgs", "avg_mph", "trip_hours"]
+QUANTILE_BUCKETS = {"hour": "hour_of_day", "month": "month_of_year", "year": "pickup_year"} # columns of trip_sketches
 
 # Logging
 logging.basicConfig(
@@ -18,285 +54,498 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def analyze_one(con, table_name, pickup_col, cab_label):
-    logger.info(f"Analyzing table: {table_name}")
-
-    # Largest co2 trip
-    max_trip_kg = con.execute(f"""
-        SELECT MAX(trip_co2_kgs)
-        FROM {table_name};
-    """).fetchone()[0]
-    logger.info(f"[Largest CO2 Trip] {cab_label}: {max_trip_kg:.3f} kg")
-    print(f"[Largest CO2 Trip]           {cab_label}: {max_trip_kg:.3f} kg")
-
-
-    # Hour of day (1-24)
-    hour_heavy = con.execute(f"""
-        SELECT hour FROM (
-            SELECT (hour_of_day + 1) AS hour,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            GROUP BY 1
-        )
-        ORDER BY avg_kg DESC
-        LIMIT 1;
-    """).fetchone()[0]
-
-
-    hour_light = con.execute(f"""
-        SELECT hour FROM (
-            SELECT (hour_of_day + 1) AS hour,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            GROUP BY 1
-        )
-        ORDER BY avg_kg ASC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    logger.info(f"[Hour (avg kg/trip)] {cab_label} heaviest={hour_heavy} | lightest={hour_light}")
-    print(f"[Hour (avg kg/trip)]         {cab_label} heaviest={hour_heavy} | lightest={hour_light}")
-
-    # Day of week (Sun-Sat)
-    dow_heavy = con.execute(f"""
-        SELECT dow FROM (
-            SELECT
-                CASE day_of_week
-                    WHEN 0 THEN 'Sun'
-                    WHEN 1 THEN 'Mon'
-                    WHEN 2 THEN 'Tue'
-                    WHEN 3 THEN 'Wed'
-                    WHEN 4 THEN 'Thu'
-                    WHEN 5 THEN 'Fri'
-                    WHEN 6 THEN 'Sat'
-                END AS dow,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            GROUP BY 1
-        )
-        ORDER BY avg_kg DESC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    dow_light = con.execute(f"""
-        SELECT dow FROM (
-            SELECT
-                CASE day_of_week
-                    WHEN 0 THEN 'Sun'
-                    WHEN 1 THEN 'Mon'
-                    WHEN 2 THEN 'Tue'
-                    WHEN 3 THEN 'Wed'
-                    WHEN 4 THEN 'Thu'
-                    WHEN 5 THEN 'Fri'
-                    WHEN 6 THEN 'Sat'
-                END AS dow,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            GROUP BY 1
-        )
-        ORDER BY avg_kg ASC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    logger.info(f"[Day of Week (avg kg/trip)] {cab_label} heaviest={dow_heavy} | lightest={dow_light}")
-    print(f"[Day of Week (avg kg/trip)]  {cab_label} heaviest={dow_heavy} | lightest={dow_light}")
-
-
-    # Week of year (1–52)
-    week_heavy = con.execute(f"""
-        SELECT week FROM (
-            SELECT CAST(week_of_year AS INT) AS week,
-                AVG(trip_co2_kgs)        AS avg_kg
-            FROM {table_name}
-            WHERE week_of_year BETWEEN 1 AND 52
-            GROUP BY 1
-        )
-        ORDER BY avg_kg DESC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    week_light = con.execute(f"""
-        SELECT week FROM (
-            SELECT CAST(week_of_year AS INT) AS week,
-                AVG(trip_co2_kgs)        AS avg_kg
-            FROM {table_name}
-            WHERE week_of_year BETWEEN 1 AND 52
-            GROUP BY 1
-        )
-        ORDER BY avg_kg ASC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    logger.info(f"[Week of Year (avg kg/trip)] {cab_label} heaviest={week_heavy} | lightest={week_light}")
-    print(f"[Week of Year (avg kg/trip)] {cab_label} heaviest={week_heavy} | lightest={week_light}")
-
-
-    # Month of year (Jan–Dec)
-    month_heavy = con.execute(f"""
-        SELECT mon FROM (
-            SELECT
-                CASE CAST(month_of_year AS INT)
-                    WHEN 1 THEN 'Jan' WHEN 2 THEN 'Feb' WHEN 3 THEN 'Mar'
-                    WHEN 4 THEN 'Apr' WHEN 5 THEN 'May' WHEN 6 THEN 'Jun'
-                    WHEN 7 THEN 'Jul' WHEN 8 THEN 'Aug' WHEN 9 THEN 'Sep'
-                    WHEN 10 THEN 'Oct' WHEN 11 THEN 'Nov' WHEN 12 THEN 'Dec'
-                END AS mon,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            WHERE month_of_year BETWEEN 1 AND 12
-            GROUP BY 1
-        )
-        ORDER BY avg_kg DESC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    month_light = con.execute(f"""
-        SELECT mon FROM (
-            SELECT
-                CASE CAST(month_of_year AS INT)
-                    WHEN 1 THEN 'Jan' WHEN 2 THEN 'Feb' WHEN 3 THEN 'Mar'
-                    WHEN 4 THEN 'Apr' WHEN 5 THEN 'May' WHEN 6 THEN 'Jun'
-                    WHEN 7 THEN 'Jul' WHEN 8 THEN 'Aug' WHEN 9 THEN 'Sep'
-                    WHEN 10 THEN 'Oct' WHEN 11 THEN 'Nov' WHEN 12 THEN 'Dec'
-                END AS mon,
-                AVG(trip_co2_kgs) AS avg_kg
-            FROM {table_name}
-            WHERE month_of_year BETWEEN 1 AND 12
-            GROUP BY 1
-        )
-        ORDER BY avg_kg ASC
-        LIMIT 1;
-    """).fetchone()[0]
-
-    logger.info(f"[Month (avg kg/trip)] {cab_label} heaviest={month_heavy} | lightest={month_light}")
-    print(f"[Month (avg kg/trip)]        {cab_label} heaviest={month_heavy} | lightest={month_light}")
-
+metrics = instrument.Instrumentation("analysis")
+
+DOW_NAMES = ["Sun", "Mon", "Tue", "Wed", "Thu", "Fri", "Sat"]
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+# Dimension -> (staging column, report heading, label for a group key or None to drop it)
+DIMENSIONS = {
+    "hour":  ("hour_of_day",   "Hour (avg kg/trip)",
+              lambda k: int(k) + 1),
+    "dow":   ("day_of_week",   "Day of Week (avg kg/trip)",
+              lambda k: DOW_NAMES[int(k)]),
+    "week":  ("week_of_year",  "Week of Year (avg kg/trip)",
+              lambda k: int(k) if 1 <= k <= 52 else None),
+    "month": ("month_of_year", "Month (avg kg/trip)",
+              lambda k: MONTH_NAMES[int(k) - 1] if 1 <= k <= 12 else None),
+}
+
+
+@dataclass
+class AnalysisResult:
+    cab_label: str
+    max_trip_kg: float
+    averages: dict = field(default_factory=dict)  # dimension -> {label: avg kg/trip}
+    heaviest: dict = field(default_factory=dict)  # dimension -> label
+    lightest: dict = field(default_factory=dict)  # dimension -> label
+    sampled: bool = False
+    intervals: dict = field(default_factory=dict)  # dimension -> {label: (low, high)}, sampled runs only
+    flips: dict = field(default_factory=dict)      # dimension -> {"heaviest"/"lightest": [labels it could swap with]}
+
+
+def connect_reader():
+    # The latest snapshot, read-only, so reports neither wait on nor block the loader;
+    # the working database (read-only too, so readers don't lock each other out) until a
+    # snapshot has been published, and always in lake mode
+    con = snapshot.connect_latest() if READ_SNAPSHOT else None
+    if con is not None:
+        logger.info(f"Reading snapshot {snapshot.latest_path()}")
+        return con
+    try:
+        return duckdb.connect(database=str(DB_PATH), read_only=True)
+    except duckdb.IOException as e:
+        raise RuntimeError(f"{DB_PATH} is locked by a writer (the pipeline, load.py or clean.py) and no snapshot "
+                           f"is published; try again when it has finished") from e
+
+
+@contextmanager
+def reader(con=None):
+    # Instrumented connection configured for analysis; without con, a connect_reader() one that is
+    # closed afterwards (a passed con is left open)
+    own_con = con is None
+    if own_con:
+        con = connect_reader()
+    try:
+        wrapped = metrics.wrap(con)
+        parallel.configure(wrapped, ANALYSIS_THREADS, ANALYSIS_MEMORY_LIMIT, ANALYSIS_TEMP_DIRECTORY)
+        yield wrapped
+    finally:
+        if own_con:
+            con.close()
 
-def analyze_tables():
 
-    con = None
+def is_base_table(con, name):
+    # dbt models are views in lake mode
+    return query.run(con, """
+        SELECT COUNT(*) FROM information_schema.tables WHERE table_name = $1 AND table_type = 'BASE TABLE';
+    """, [name]).fetchone()[0] > 0
+
+
+def sample_clause(sample):
+    # Validated, since it goes into the SQL text
+    size = sample.strip()
+    by_rows = re.fullmatch(r"\d+\s*ROWS", size, re.IGNORECASE)
+    if not by_rows and not re.fullmatch(r"\d+(\.\d+)?\s*(%|PERCENT)", size, re.IGNORECASE):
+        raise ValueError(f"Bad sample size {sample!r}, expected e.g. '1%' or '500000 ROWS'")
+    if SAMPLE_METHOD not in ("bernoulli", "reservoir", "system"):
+        raise ValueError(f"Bad sample method {SAMPLE_METHOD!r}")
+    # Only reservoir sampling can take a row count; SAMPLE_METHOD applies to percentages
+    method = "reservoir" if by_rows else SAMPLE_METHOD
+    return f"USING SAMPLE {size} ({method}, {int(SAMPLE_SEED)})"
+
+
+def source_exprs(source, use_rollup):
+    # Rollup rows carry sums and counts, so weight averages by trip_count
+    if use_rollup:
+        return CO2_ROLLUP, "SUM(co2_kgs_sum) / SUM(trip_count)", "MAX(co2_kgs_max)"
+    return source, "AVG(trip_co2_kgs)", "MAX(trip_co2_kgs)"
+
+
+def dimension_rows(con, source, avg_expr, max_expr, by_taxi=False, taxi=None, sample=None):
+    # Every dimension's averages plus the overall max in one scan, for one taxi type
+    # of the source or all of them at once. Sampled runs also return each group's
+    # standard deviation and sample size for the confidence intervals.
+    source = query.ident(source)
+    cols = [col for col, _, _ in DIMENSIONS.values()]
+    prefix = "taxi_type, " if by_taxi else ""
+    dim_case = "\n".join(
+        f"WHEN GROUPING({col}) = 0 THEN '{dim}'" for dim, (col, _, _) in DIMENSIONS.items()
+    )
+    sets = ", ".join(f"({prefix}{col})" for col in cols)
+    total = "(taxi_type)" if by_taxi else "()"
+    relation, spread = source, ""
+    if sample:
+        relation = f"(SELECT * FROM {source} {sample_clause(sample)}) AS sampled"
+        spread = ",\n            STDDEV_SAMP(trip_co2_kgs) AS sd_kg,\n            COUNT(*) AS n"
+    return result_cache.cached(con, f"""
+        SELECT
+            {"taxi_type" if by_taxi else "NULL"} AS taxi,
+            CASE {dim_case} ELSE 'all' END AS dim,
+            COALESCE({", ".join(cols)}) AS key,
+            {avg_expr} AS avg_kg,
+            {max_expr} AS max_kg{spread}
+        FROM {relation}
+        {"WHERE taxi_type = $1" if taxi else ""}
+        GROUP BY GROUPING SETS ({sets}, {total});
+    """, [source], params=[taxi] if taxi else [])
+
+
+def build_result(cab_label, rows):
+    result = AnalysisResult(cab_label=cab_label, max_trip_kg=None)
+    z = NormalDist().inv_cdf(0.5 + CONFIDENCE / 2)
+    for row in rows:
+        _, dim, key, avg_kg, max_kg = row[:5]
+        if dim == "all":
+            result.max_trip_kg = max_kg
+            continue
+        if key is None or avg_kg is None:
+            continue
+        label = DIMENSIONS[dim][2](key)
+        if label is None:
+            continue
+        result.averages.setdefault(dim, {})[label] = avg_kg
+        if len(row) > 5:
+            # Normal approximation of the mean; a single sampled trip gives no spread, so an unbounded interval
+            sd_kg, n = row[5:7]
+            half = z * sd_kg / n ** 0.5 if sd_kg is not None and n > 1 else float("inf")
+            result.sampled = True
+            result.intervals.setdefault(dim, {})[label] = (avg_kg - half, avg_kg + half)
+
+    # Heaviest/lightest from the small grouped result
+    for dim, avgs in result.averages.items():
+        result.heaviest[dim] = max(avgs, key=avgs.get)
+        result.lightest[dim] = min(avgs, key=avgs.get)
+        if dim in result.intervals:
+            result.flips[dim] = ranking_flips(result.intervals[dim], result.heaviest[dim], result.lightest[dim])
+    return result
+
+
+def ranking_flips(intervals, heaviest, lightest):
+    # Labels whose interval overlaps the winner's, i.e. that could take its place on the full data,
+    # closest rival first
+    top_low, bottom_high = intervals[heaviest][0], intervals[lightest][1]
+    by_high = sorted(intervals, key=lambda l: intervals[l][1], reverse=True)
+    by_low = sorted(intervals, key=lambda l: intervals[l][0])
+    return {
+        "heaviest": [l for l in by_high if l != heaviest and intervals[l][1] >= top_low],
+        "lightest": [l for l in by_low if l != lightest and intervals[l][0] <= bottom_high],
+    }
+
+
+def analyze_one(con, table_name, cab_label, use_rollup=False, sample=None):
+    # Single table (or one taxi of the rollup)
+    source, avg_expr, max_expr = source_exprs(table_name, use_rollup)
+    taxi = cab_label.lower() if use_rollup else None
+    logger.info(f"Analyzing {cab_label} from {source}" + (f" (sample {sample})" if sample else ""))
+
+    with metrics.stage("analyze", item=cab_label.lower()) as m:
+        rows = dimension_rows(con, source, avg_expr, max_expr, taxi=taxi, sample=sample)
+        m["rows_out"] = len(rows)
+    result = build_result(cab_label, rows)
+    report(result)
+    return result
+
+
+def analyze_all(con, use_rollup=False, sample=None):
+    # Both taxi types from the unified fact table (or rollup) in one grouped scan
+    source, avg_expr, max_expr = source_exprs(FCT_TRIPS, use_rollup)
+    logger.info(f"Analyzing all taxi types from {source}" + (f" (sample {sample})" if sample else ""))
+
+    with metrics.stage("analyze", item="all") as m:
+        rows = dimension_rows(con, source, avg_expr, max_expr, by_taxi=True, sample=sample)
+        m["rows_out"] = len(rows)
+    results = {}
+    for taxi, label in TAXI_LABELS.items():
+        results[taxi] = build_result(label, [r for r in rows if r[0] == taxi])
+        report(results[taxi])
+    return results
+
+
+def report(result):
+    cab_label = result.cab_label
+    if result.max_trip_kg is not None:
+        # The largest sampled trip only bounds the true maximum from below
+        note = " (largest in sample)" if result.sampled else ""
+        logger.info(f"[Largest CO2 Trip] {cab_label}: {result.max_trip_kg:.3f} kg{note}")
+        print(f"[Largest CO2 Trip]           {cab_label}: {result.max_trip_kg:.3f} kg{note}")
+
+    for dim, (_, heading, _) in DIMENSIONS.items():
+        if dim not in result.heaviest:
+            continue
+        line = f"{cab_label} heaviest={result.heaviest[dim]} | lightest={result.lightest[dim]}"
+        if dim in result.intervals:
+            line += interval_note(result, dim)
+        logger.info(f"[{heading}] {line}")
+        print(f"{'[' + heading + ']':<29}{line}")
+
+
+def interval_note(result, dim):
+    # e.g. " (95% CI 2.310-2.350 / 2.020-2.060; heaviest could flip with 17, 19)"
+    intervals = result.intervals[dim]
+    top, bottom = intervals[result.heaviest[dim]], intervals[result.lightest[dim]]
+    note = f" ({CONFIDENCE:.0%} CI {top[0]:.3f}-{top[1]:.3f} / {bottom[0]:.3f}-{bottom[1]:.3f}"
+    for rank, others in result.flips[dim].items():
+        if others:
+            more = f" +{len(others) - FLIPS_SHOWN} more" if len(others) > FLIPS_SHOWN else ""
+            note += f"; {rank} could flip with {', '.join(map(str, others[:FLIPS_SHOWN]))}{more}"
+    return note + ")"
+
+
+# Returns the results, or None on error; pass con to reuse an open connection (left open afterwards).
+# sample (e.g. "1%") answers from a sample of trips with confidence intervals, default SAMPLE.
+def analyze_tables(con=None, sample=None):
+
+    sample = sample or SAMPLE
 
     try:
 
         logger.info("------ New run ---------------")
         # Connect to local duckdb
-        con = duckdb.connect(database= DB_PATH, read_only = False)
-
-        # Yellow analytics
-        analyze_one(
-            con,
-            table_name = STG_YELLOW,
-            pickup_col = "tpep_pickup_datetime",
-            cab_label  = "YELLOW"
-        )
+        with reader(con) as con:
+            # Sampling needs trip-level rows, so a sampled run skips the rollup
+            use_rollup = USE_ROLLUP and not sample and query.table_exists(con, CO2_ROLLUP)
+            if USE_ROLLUP and not sample and not use_rollup:
+                logger.warning(f"{CO2_ROLLUP} not built yet, scanning the staging tables")
 
-        # Green analytics 
-        analyze_one(
-            con,
-            table_name = STG_GREEN,
-            pickup_col = "lpep_pickup_datetime",
-            cab_label  = "GREEN"
-        )
+            results = analyze_all(con, use_rollup=use_rollup, sample=sample)
+            metrics.finish(con)
+            return results
 
     except Exception as e: 
         logger.error(f"An error occurred: {e}")
-    finally: 
-        if con is not None:
-            con.close()
-
-
-
-def plot_over_time(con, year_start, year_end, 
-                    out_path, yellow_pickup, green_pickup):
-
-    logger.info(f"Plotting years {year_start} to {year_end}")
-
-    # Build where clauses
-    y_where = f"""
-        WHERE EXTRACT(YEAR FROM {yellow_pickup}) 
-        BETWEEN {int(year_start)} AND {int(year_end)}
-    """
 
-    g_where = f"""
-        WHERE EXTRACT(YEAR FROM {green_pickup}) 
-        BETWEEN {int(year_start)} AND {int(year_end)}
-    """
 
-    # Yellow yearlys into df 
-    yearly_yellow_df = con.execute(f"""
-        SELECT CAST(strftime({yellow_pickup}, '%Y') AS INT) AS yr,
-        SUM(trip_co2_kgs) AS total_kg
-        FROM stg_yellow {y_where}
-        GROUP BY 1
-        ORDER BY 1;
-    """).df()
-    logger.info(f"Created yellow monthly co2 df for plotting")
-
-    # Green yearlys into df
-    yearly_green_df = con.execute(f"""
-        SELECT CAST(strftime({green_pickup}, '%Y') AS INT) AS yr,
-        SUM(trip_co2_kgs) AS total_kg
-        FROM stg_green {g_where}
-        GROUP BY 1
-        ORDER BY 1;
-    """).df()
-    logger.info(f"Created green monthly co2 df for plotting")
-
-    # Convert yr to numeric
-    yearly_yellow_df["yr"] = yearly_yellow_df["yr"].astype(int)
-    yearly_green_df["yr"] = yearly_green_df["yr"].astype(int)
-
-
-    # Line plot 
-    fig, ax = plt.subplots(figsize=(11, 5))
-
-    ax.plot(yearly_yellow_df["yr"], yearly_yellow_df["total_kg"],
-            marker="o", label="Yellow Taxi", color="#FFD700")
-    ax.plot(yearly_green_df["yr"], yearly_green_df["total_kg"],
-            marker="o", label="Green Taxi",  color="green")
-
-    # Use log scale on y-axis (otherwise green looks like it's always 0)
-    ax.set_yscale("log")  
-
-    # Clean up y-axis to show relevant ticks and abbreviate thousand to K and million to M
-    ax.yaxis.set_major_locator(LogLocator(base=10, subs=(1.0, 2.0, 5.0), numticks=12))
-    ax.yaxis.set_major_formatter(
-        FuncFormatter(lambda v, _: f"{v/1e6:.1f}M" if v >= 1e6 else f"{v/1e3:.0f}k")
-    )
+def plot_tables(con=None, plots=None):
+    # CO2 charts over the configured years (PLOTS by default), all from one series store build
+    plots = PLOTS if plots is None else plots
+    with reader(con) as con:
+        with metrics.stage("series", item=str(series.SERIES_PATH)) as m:
+            table = series.build_series(con, int(YEARS[0]), int(YEARS[-1]))
+            m["rows_out"] = table.num_rows
+        with metrics.stage("plot", item=", ".join(map(str, plots.values()))):
+            series.render(plots, table)
+        metrics.finish(con)
 
-    # Clean up x-axis ticks every year
-    ax.xaxis.set_major_locator(MultipleLocator(1))
-    ax.set_xlim(int(year_start), int(year_end))
 
-    # Titles and legend
-    ax.set_xlabel("Year")
-    ax.set_ylabel("Total CO2 (kg, log scale)")
-    ax.set_title(f"Yearly Taxi CO2 Totals ({year_start}-{year_end})")
-    ax.legend()
-    ax.grid(True, which="both", axis="y", alpha=0.3)
-    
-    # Fix the borders
-    xmin = min(yearly_yellow_df["yr"].min(), yearly_green_df["yr"].min())
-    xmax = max(yearly_yellow_df["yr"].max(), yearly_green_df["yr"].max())
-    ax.set_xlim(int(xmin) - 0.5, int(xmax) + 0.5)  
+def year_filter(year):
+    # WHERE clause and params for trips picked up in one year; the source file year only prunes partitions
+    if not year:
+        return "", []
+    return ("WHERE year BETWEEN $1 AND $2 AND EXTRACT(YEAR FROM pickup_time) = $3",
+            [int(year) - 1, int(year) + 1, int(year)])
 
-    plt.tight_layout()
-    plt.savefig(out_path, dpi=150, bbox_inches="tight")
-    plt.close(fig)
 
+# Top-K trips
+def top_trips(con, k=TOP_K, by=None, year=None):
+    """Full fact rows of the k highest-CO2 trips per taxi type, or per taxi type and TOP_BUCKETS
+    bucket `by`, ranked 1..k, as an Arrow table (bucket, rank, then the fact columns).
 
-    logger.info(f"Saved plot: {out_path}")
-    print(f"[Plot] Saved: {out_path}")
+    One grouped max_by(..., k) pass keeps k candidates per group instead of sorting the trips.
+    On a table only the winners' rowids are kept and their rows looked up afterwards; a lake
+    view has no rowid, so there the rows themselves are kept. Ties are broken arbitrarily.
+    """
+    if by is not None and by not in TOP_BUCKETS:
+        raise ValueError(f"Unknown bucket {by!r}, expected one of {', '.join(TOP_BUCKETS)}")
+    bucket = TOP_BUCKETS[by] if by else "NULL"
+    where, params = year_filter(year)
+    k_param = f"${len(params) + 1}"
+    # Enum columns of the compact schema come back as plain strings
+    as_text = "REPLACE (CAST(taxi_type AS VARCHAR) AS taxi_type, CAST(vehicle_type AS VARCHAR) AS vehicle_type)"
+
+    if is_base_table(con, FCT_TRIPS):
+        sql = f"""
+            WITH top AS (
+                SELECT bucket, rank, id
+                FROM (
+                    SELECT taxi_type, {bucket} AS bucket, max_by(rowid, trip_co2_kgs, {k_param}) AS ids
+                    FROM {FCT_TRIPS}
+                    {where}
+                    GROUP BY ALL
+                ), UNNEST(ids) WITH ORDINALITY AS u(id, rank)
+            )
+            SELECT top.bucket, top.rank, trips.* EXCLUDE (id) {as_text}
+            FROM (SELECT rowid AS id, * FROM {FCT_TRIPS} WHERE rowid IN (SELECT id FROM top)) AS trips
+            JOIN top USING (id)
+            ORDER BY trips.taxi_type, top.bucket, top.rank;
+        """
+    else:
+        sql = f"""
+            SELECT * {as_text}
+            FROM (
+                SELECT bucket, rank, trip.*
+                FROM (
+                    SELECT taxi_type, {bucket} AS bucket, max_by(t, trip_co2_kgs, {k_param}) AS trips
+                    FROM {FCT_TRIPS} AS t
+                    {where}
+                    GROUP BY ALL
+                ), UNNEST(trips) WITH ORDINALITY AS u(trip, rank)
+            )
+            ORDER BY taxi_type, bucket, rank;
+        """
+    return result_cache.cached(con, sql, [FCT_TRIPS], fetch="to_arrow_table", params=params + [int(k)])
+
+
+def report_top(top, by=None):
+    # One line per trip, grouped by taxi type and bucket
+    for row in top.to_pylist():
+        bucket = row["bucket"]
+        if by in series.GRAINS:
+            bucket = bucket.strftime(series.GRAINS[by][2])
+        where = f" {by}={bucket}" if by else ""
+        line = (f"{row['taxi_type'].upper()}{where} #{row['rank']}: {row['trip_co2_kgs']:.3f} kg, "
+                f"{row['trip_distance']:.1f} mi, {row['passenger_count']} pax, picked up {row['pickup_time']:%Y-%m-%d %H:%M}, "
+                f"{row['source_file']}")
+        logger.info(f"[Top CO2 Trips] {line}")
+        print(f"{'[Top CO2 Trips]':<29}{line}")
+
+
+def top_tables(con=None, k=TOP_K, by=None, year=None):
+    # Prints and returns the top-k trips; pass con to reuse an open connection (left open afterwards)
+    with reader(con) as con:
+        with metrics.stage("top_trips", item=by or "all") as m:
+            top = top_trips(con, k, by, year)
+            m["rows_out"] = top.num_rows
+        report_top(top, by)
+        metrics.finish(con)
+        return top
+
+
+# Quantiles from sketches
+def quantiles(con, columns=None, qs=None, by=None, years=None, taxis=None):
+    """Quantiles of the SKETCH_METRICS columns merged from the trip_sketches histograms, as an Arrow table
+    (taxi_type, bucket, metric, quantile, value, trip_count).
+
+    by: a QUANTILE_BUCKETS key or None; years: (first, last) pickup year; taxis: taxi types merged
+    into one distribution (taxi_type "green+yellow"), or None for one per taxi type.
+    Each value is within SKETCH_ACCURACY (relative) of the exact nearest-rank quantile. Only
+    histogram bins are read, so any range costs the same however many trips it covers.
+    """
+    columns = SKETCH_METRICS if columns is None else columns
+    qs = QUANTILES if qs is None else qs
+    if by is not None and by not in QUANTILE_BUCKETS:
+        raise ValueError(f"Unknown bucket {by!r}, expected one of {', '.join(QUANTILE_BUCKETS)}")
+    bucket = QUANTILE_BUCKETS[by] if by else "NULL"
+    params = [list(columns), [float(q) for q in qs]]
+    filters = ["metric = ANY($1)"]
+    taxi_expr = "CAST(taxi_type AS VARCHAR)"
+    if years:
+        params += [int(years[0]), int(years[1])]
+        filters.append(f"pickup_year BETWEEN ${len(params) - 1} AND ${len(params)}")
+    if taxis:
+        params += [sorted(taxis), "+".join(sorted(taxis))]
+        filters.append(f"list_contains(${len(params) - 1}, CAST(taxi_type AS VARCHAR))")
+        taxi_expr = f"${len(params)}"
+
+    sql = f"""
+        WITH merged AS (
+            -- Merging sketches = adding up their bins
+            SELECT {taxi_expr} AS taxi_type, {bucket} AS bucket, metric, bin,
+                SUM(trip_count) AS trip_count, MIN(value_min) AS value_min, MAX(value_max) AS value_max,
+                ANY_VALUE(gamma) AS gamma
+            FROM {TRIP_SKETCHES}
+            WHERE {" AND ".join(filters)}
+            GROUP BY ALL
+        ), cumulative AS (
+            SELECT *,
+                SUM(trip_count) OVER (PARTITION BY taxi_type, bucket, metric ORDER BY bin NULLS FIRST) AS trips_upto,
+                SUM(trip_count) OVER (PARTITION BY taxi_type, bucket, metric) AS total
+            FROM merged
+        )
+        -- Each quantile's value is the first bin holding its rank: the bin midpoint (relative to its
+        -- bounds), kept inside the values the bin actually saw
+        SELECT taxi_type, bucket, metric, q AS quantile,
+            arg_min(CASE WHEN bin IS NULL THEN value_max
+                         ELSE LEAST(GREATEST(2 * pow(gamma, bin) / (gamma + 1), value_min), value_max) END,
+                    trips_upto) AS value,
+            ANY_VALUE(total) AS trip_count
+        FROM cumulative, UNNEST(CAST($2 AS DOUBLE[])) AS u(q)
+        WHERE trips_upto > floor(q * (total - 1))
+        GROUP BY ALL
+        ORDER BY taxi_type, bucket, metric, quantile;
+    """
+    return result_cache.cached(con, sql, [TRIP_SKETCHES], fetch="to_arrow_table", params=params)
+
+
+def report_quantiles(table, by=None):
+    # One line per taxi type, bucket and metric: p50 | p95 | p99
+    lines = {}
+    for row in table.to_pylist():
+        where = f" {by}={row['bucket']}" if by else ""
+        key = (f"{row['taxi_type'].upper()}{where} {row['metric']}", row["trip_count"])
+        lines.setdefault(key, []).append(f"p{row['quantile'] * 100:g} {row['value']:.3f}")
+    for (label, trip_count), values in lines.items():
+        line = f"{label}: {' | '.join(values)} ({trip_count:,} trips)"
+        logger.info(f"[Quantiles] {line}")
+        print(f"{'[Quantiles]':<29}{line}")
+
+
+def quantile_tables(con=None, columns=None, qs=None, by=None, years=None, taxis=None):
+    # Prints and returns quantiles(); pass con to reuse an open connection (left open afterwards)
+    with reader(con) as con:
+        if not query.table_exists(con, TRIP_SKETCHES):
+            logger.warning(f"{TRIP_SKETCHES} not built yet, run dbt first")
+            print(f"[Quantiles] {TRIP_SKETCHES} not built yet, run dbt first")
+            return None
+        with metrics.stage("quantiles", item=by or "all") as m:
+            table = quantiles(con, columns, qs, by, years, taxis)
+            m["rows_out"] = table.num_rows
+        report_quantiles(table, by)
+        metrics.finish(con)
+        return table
+
+
+# Streaming extracts
+def stream_query(con, sql, params=(), batch_rows=EXPORT_BATCH_ROWS):
+    """Returns a pyarrow RecordBatchReader over the result of sql ($1, $2, ... bound to params).
+
+    Batches come straight from DuckDB's Arrow output, so memory stays around one batch
+    however large the result is. Read it to the end before running anything else on con.
+    """
+    return query.run(con, sql, params).to_arrow_reader(batch_rows)
+
+
+def write_batches(batches, out_path):
+    # .parquet or .csv, one record batch at a time; returns the rows written
+    out_path = Path(out_path)
+    writer_cls = pa_csv.CSVWriter if out_path.suffix == ".csv" else pq.ParquetWriter
+    rows = 0
+    with writer_cls(str(out_path), batches.schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def export_trips(con=None, out_path="trips.parquet", year=None, columns=None):
+    # Per-trip rows of the fact model (optionally one pickup year and some columns) streamed to a file
+    where, params = year_filter(year)
+    with reader(con) as con:
+        with metrics.stage("export", item=str(out_path)) as m:
+            batches = stream_query(con, f"""
+                SELECT {", ".join(map(query.ident, columns)) if columns else "*"}
+                FROM {FCT_TRIPS}
+                {where};
+            """, params)
+            m["rows_out"] = write_batches(batches, out_path)
+        logger.info(f"Exported {m['rows_out']} trips to {out_path}")
+        print(f"[Export] {m['rows_out']} trips saved: {out_path}")
+        metrics.finish(con)
 
 
 if __name__ == "__main__":
-    analyze_tables()
-
-    # Connection for plot function
-    con = duckdb.connect(database=DB_PATH, read_only=False)
-    try:
-        plot_over_time(con, 2015, 2024, out_path="co2_by_year.png",
-                       yellow_pickup="tpep_pickup_datetime",
-                       green_pickup="lpep_pickup_datetime")
-    finally:
-        con.close()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Answer the CO2 questions and plot CO2 totals over time")
+    parser.add_argument("--sample", default=SAMPLE,
+                        help="answer from a sample of trips, e.g. 1%% or '500000 ROWS', with confidence intervals")
+    parser.add_argument("--export", metavar="PATH",
+                        help="instead, stream the per-trip fact rows to a .parquet or .csv file")
+    parser.add_argument("--export-year", type=int, help="only export trips picked up in this year")
+    parser.add_argument("--top", type=int, metavar="K",
+                        help="instead, list the K highest-CO2 trips per taxi type (and bucket, see --top-by)")
+    parser.add_argument("--top-by", choices=list(TOP_BUCKETS), help="rank trips within each day/week/month/year/hour")
+    parser.add_argument("--top-year", type=int, help="only rank trips picked up in this year")
+    parser.add_argument("--quantiles", nargs="+", choices=SKETCH_METRICS, metavar="COLUMN",
+                        help="instead, print the QUANTILES (p50/p95/p99) of these trip columns "
+                             f"({' '.join(SKETCH_METRICS)}) merged from the {TRIP_SKETCHES} model")
+    parser.add_argument("--quantile-by", choices=list(QUANTILE_BUCKETS), help="one distribution per hour/month/year")
+    parser.add_argument("--quantile-years", type=int, nargs=2, metavar=("FIRST", "LAST"),
+                        help="only trips picked up in these years")
+    parser.add_argument("--quantile-taxis", nargs="+", choices=TAXIS,
+                        help="merge these taxi types into one distribution instead of one per taxi type")
+    parser.add_argument("--plots", nargs="+", choices=list(series.GRAINS), metavar="GRAIN",
+                        help="instead, only render co2_by_<grain>.png for these grains (day week month year) "
+                             "from the series store, without querying the database")
+    args = parser.parse_args()
+
+    if args.export:
+        export_trips(out_path=args.export, year=args.export_year)
+    elif args.top:
+        top_tables(k=args.top, by=args.top_by, year=args.top_year)
+    elif args.quantiles:
+        quantile_tables(columns=args.quantiles, by=args.quantile_by, years=args.quantile_years,
+                        taxis=args.quantile_taxis)
+    elif args.plots:
+        series.render({grain: PLOTS.get(grain, f"co2_by_{grain}.png") for grain in args.plots})
+    else:
+        analyze_tables(sample=args.sample)
+        plot_tables()
\ No newline at end of file
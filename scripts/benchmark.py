@@ -0,0 +1,269 @@
+import duckdb
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import analysis
+import clean
+import instrument
+import load
+from config import STG_YELLOW, STG_GREEN
+
+
+# Configs
+BENCH_DIR = Path("bench")
+WORK_DIR = BENCH_DIR / "work"       # generated parquet and scratch databases, safe to delete
+RESULTS_DIR = BENCH_DIR / "results" # one JSON file per benchmark run
+DBT_DIR = Path("dbt")
+
+SCALES = {"1m": 1_000_000, "10m": 10_000_000, "100m": 100_000_000} # total trips, both taxi types
+YELLOW_SHARE = 0.8   # share of trips that are yellow
+BENCH_YEAR = 2024    # synthetic trips cover the 12 months of this year
+DUP_RATE = 0.01      # share of rows that are exact copies of another row
+OUTLIER_RATE = 0.02  # share of rows that break one of the clean.py rules
+SEED = 42
+
+REGRESSION_THRESHOLD = 1.2 # compare() flags steps that got this much slower
+
+
+# Synthetic data
+def generate_month(con, taxi, month, rows, out, dup_rate=DUP_RATE, outlier_rate=OUTLIER_RATE, seed=SEED):
+    # TLC column names plus a few columns ingest ignores. Every value is a hash of
+    # (row, field, seed), so the same settings always give the same file.
+    prefix = "tpep" if taxi == "yellow" else "lpep"
+    extra = "" if taxi == "yellow" else ", 1 AS trip_type"
+    unique = max(1, round(rows / (1 + dup_rate)))
+    salt = seed * 1000 + month * 10 + (1 if taxi == "yellow" else 2)
+    start = datetime(BENCH_YEAR, month, 1)
+    month_seconds = ((datetime(BENCH_YEAR + month // 12, month % 12 + 1, 1)) - start).total_seconds()
+
+    con.execute(f"""
+        COPY (
+            WITH base AS (
+                SELECT
+                    i,
+                    (hash(i, 1, {salt}) % 1000000) / 1000000.0 AS u_time,
+                    (hash(i, 2, {salt}) % 1000000) / 1000000.0 AS u_len,
+                    (hash(i, 3, {salt}) % 1000000) / 1000000.0 AS u_dist,
+                    (hash(i, 4, {salt}) % 1000000) / 1000000.0 AS u_pass,
+                    (hash(i, 5, {salt}) % 1000000) / 1000000.0 AS u_out,
+                    hash(i, 6, {salt}) % 4 AS outlier_kind
+                FROM range({unique}) AS r(i)
+            ),
+            trips AS (
+                SELECT
+                    i,
+                    CAST(1 + i % 2 AS INTEGER) AS VendorID,
+                    TIMESTAMP '{start}' + to_seconds(CAST(u_time * {month_seconds} AS BIGINT)) AS pickup,
+                    -- 2 to 60 minute trips; long-trip outliers last more than a day
+                    to_seconds(CAST(120 + u_len * 3480 AS BIGINT)
+                        + CASE WHEN u_out < {outlier_rate} AND outlier_kind = 3 THEN 90000 ELSE 0 END) AS duration,
+                    CASE WHEN u_out < {outlier_rate} AND outlier_kind = 0 THEN 0
+                         ELSE 1 + CAST(u_pass * u_pass * 5 AS BIGINT) END AS passenger_count,
+                    CASE WHEN u_out < {outlier_rate} AND outlier_kind = 1 THEN 0.0
+                         WHEN u_out < {outlier_rate} AND outlier_kind = 2 THEN round(100 + u_dist * 400, 2)
+                         ELSE round(0.1 + u_dist * u_dist * 20, 2) END AS trip_distance
+                FROM base
+            )
+            SELECT
+                VendorID,
+                pickup AS {prefix}_pickup_datetime,
+                pickup + duration AS {prefix}_dropoff_datetime,
+                passenger_count,
+                trip_distance,
+                CAST(1 + hash(i, 7, {salt}) % 265 AS INTEGER) AS PULocationID,
+                CAST(1 + hash(i, 8, {salt}) % 265 AS INTEGER) AS DOLocationID,
+                round(3 + trip_distance * 2.5, 2) AS fare_amount
+                {extra}
+            FROM trips
+            -- exact duplicates: the first rows of the month appear twice
+            , range(CASE WHEN i < {rows - unique} THEN 2 ELSE 1 END)
+        ) TO '{out}' (FORMAT parquet);
+    """)
+
+
+def generate_trips(total_rows, data_dir, dup_rate=DUP_RATE, outlier_rate=OUTLIER_RATE, seed=SEED):
+    # One file per taxi per month of BENCH_YEAR, named like the downloaded TLC files
+    data_dir.mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect()
+    try:
+        for taxi in load.TAXIS:
+            taxi_rows = round(total_rows * (YELLOW_SHARE if taxi == "yellow" else 1 - YELLOW_SHARE))
+            for month in range(1, 13):
+                rows = taxi_rows // 12 + (1 if month <= taxi_rows % 12 else 0)
+                out = data_dir / f"{taxi}_tripdata_{BENCH_YEAR}-{month:02d}.parquet"
+                if not out.exists():
+                    generate_month(con, taxi, month, rows, out, dup_rate, outlier_rate, seed)
+    finally:
+        con.close()
+    shutil.copy(load.DATA_DIR / "vehicle_emissions.csv", data_dir / "vehicle_emissions.csv")
+
+
+# Benchmark steps
+def run_dbt(db_path, target_dir):
+    # Staging transforms run as a separate process, so the database must be closed first
+    dbt = shutil.which("dbt")
+    if dbt is None:
+        return "skipped: dbt not installed"
+    env = dict(os.environ, TAXI_DB_PATH=str(db_path.resolve()))
+    proc = subprocess.run(
+        [dbt, "run", "--full-refresh", "--project-dir", str(DBT_DIR), "--profiles-dir", str(DBT_DIR),
+         "--target-path", str((target_dir / "target").resolve()), "--log-path", str((target_dir / "logs").resolve()),
+         "--select", "fct_trips_co2", "stg_yellow", "stg_green"],
+        env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"dbt run failed:\n{proc.stdout[-2000:]}")
+    return "ok"
+
+
+def run_scale(bench, name, total_rows, dup_rate=DUP_RATE, outlier_rate=OUTLIER_RATE, seed=SEED):
+    # Generated files are kept per setting and reused; the database is rebuilt every time
+    data_dir = WORK_DIR / f"data_{total_rows}_{dup_rate}_{outlier_rate}_{seed}"
+    scale_dir = WORK_DIR / name
+    shutil.rmtree(scale_dir, ignore_errors=True)
+    scale_dir.mkdir(parents=True)
+    db_path = scale_dir / "taxi.duckdb"
+
+    with bench.stage("generate", rows_in=total_rows) as m:
+        generate_trips(total_rows, data_dir, dup_rate, outlier_rate, seed)
+        m["rows_out"] = total_rows
+
+    # Point the scripts at the synthetic files and scratch database
+    load.DATA_DIR, load.EMISSIONS_CSV = data_dir, data_dir / "vehicle_emissions.csv"
+    load.DB_PATH = clean.DB_PATH = analysis.DB_PATH = db_path
+    load.YEARS = [str(BENCH_YEAR)]
+    load.STORAGE_MODE = clean.STORAGE_MODE = "duckdb"
+    load.metrics = clean.metrics = analysis.metrics = bench
+
+    con = bench.wrap(duckdb.connect(database=str(db_path), read_only=False))
+    try:
+        load.create_tables(con)
+        load.load_emissions(con)
+        for taxi in load.TAXIS:
+            load.ingest_stage(con, taxi)
+
+        cleaned = 0
+        for table, cols in ((clean.YELLOW_TABLE, clean.YELLOW_COLS), (clean.GREEN_TABLE, clean.GREEN_COLS)):
+            cleaned += clean.clean_one(con, table, cols[0], cols[1], run_id=bench.run_id)
+    finally:
+        con.close()
+
+    with bench.stage("staging", rows_in=cleaned) as m:
+        status = run_dbt(db_path, scale_dir / "dbt")
+        if status != "ok":
+            m["status"] = status
+    if status != "ok":
+        print(f"[bench] {name}: staging {status}, skipping analysis")
+        return
+
+    con = bench.wrap(duckdb.connect(database=str(db_path), read_only=False))
+    try:
+        analysis.analyze_one(con, STG_YELLOW, "YELLOW")
+        analysis.analyze_one(con, STG_GREEN, "GREEN")
+    finally:
+        con.close()
+
+
+def git_commit():
+    repo = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo,
+                                    capture_output=True, text=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def summarize(records):
+    # (stage, item) -> wall time and throughput; nested per-partition steps stay in "stages"
+    summary = {}
+    for rec in records:
+        key = f"{rec['stage']} {rec['item']}" if rec["item"] else rec["stage"]
+        # Throughput is over input rows; analysis stages only know what DuckDB scanned
+        rows = rec["rows_in"] if rec["rows_in"] is not None else (rec["rows_scanned"] or rec["rows_out"])
+        summary[key] = {
+            "wall_s": rec["wall_s"],
+            "rows": rows,
+            "rows_per_s": round(rows / rec["wall_s"]) if rows and rec["wall_s"] else None,
+            "duckdb_peak_bytes": rec["duckdb_peak_bytes"],
+        }
+    return summary
+
+
+def run_benchmarks(scales, dup_rate=DUP_RATE, outlier_rate=OUTLIER_RATE, seed=SEED):
+    bench = instrument.Instrumentation("benchmark")
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "duckdb": duckdb.__version__,
+        },
+        "params": {"dup_rate": dup_rate, "outlier_rate": outlier_rate, "seed": seed,
+                   "yellow_share": YELLOW_SHARE, "year": BENCH_YEAR},
+        "scales": {},
+    }
+
+    for name in scales:
+        print(f"[bench] {name}: {SCALES[name]:,} trips")
+        first = len(bench.records)
+        run_scale(bench, name, SCALES[name], dup_rate, outlier_rate, seed)
+        records = bench.records[first:]
+        results["scales"][name] = {
+            "rows": SCALES[name],
+            "summary": summarize(r for r in records
+                                 if r["stage"] in ("generate", "ingest", "clean", "staging", "analyze")),
+            "stages": records,
+        }
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    out = RESULTS_DIR / f"{datetime.now():%Y%m%d_%H%M%S}_{(commit or 'nogit')[:12]}.json"
+    out.write_text(json.dumps(results, indent=2))
+    print(f"[bench] results saved to {out}")
+    return out
+
+
+def compare(old_path, new_path):
+    # Wall time ratio per step present in both runs; generation is skipped since its files are cached
+    old = json.loads(Path(old_path).read_text())
+    new = json.loads(Path(new_path).read_text())
+    print(f"{'step':<40}{'old s':>10}{'new s':>10}{'ratio':>8}")
+    regressions = 0
+    for name, scale in new["scales"].items():
+        before = old["scales"].get(name, {}).get("summary", {})
+        for step, stats in scale["summary"].items():
+            if step == "generate" or step not in before or not before[step]["wall_s"]:
+                continue
+            ratio = stats["wall_s"] / before[step]["wall_s"]
+            flag = "  <-- slower" if ratio >= REGRESSION_THRESHOLD else ""
+            regressions += bool(flag)
+            print(f"{name + ' ' + step:<40}{before[step]['wall_s']:>10.2f}{stats['wall_s']:>10.2f}{ratio:>8.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark load, clean, dbt staging and analysis on synthetic trips")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["1m"])
+    parser.add_argument("--dup-rate", type=float, default=DUP_RATE)
+    parser.add_argument("--outlier-rate", type=float, default=OUTLIER_RATE)
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run_benchmarks(args.scales, args.dup_rate, args.outlier_rate, args.seed)
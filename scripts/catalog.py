@@ -0,0 +1,193 @@
+import duckdb
+
+import argparse
+import logging
+import re
+import time
+
+import query
+from config import (DB_PATH, DATA_DIR, TAXIS, COMPACT_SCHEMA, WIDE_TYPES, COMPACT_TYPES, CATALOG_TABLE,
+                    YELLOW_COLS, GREEN_COLS)
+
+
+# Parquet footer catalog: row counts, pickup time range (from row group statistics) and column
+# types of every source file, read from the footers only. load.py checks and plans ingest from it.
+
+FILE_RE = re.compile(r"(?P<taxi>[a-z]+)_tripdata_(?P<year>\d{4})-(?P<month>\d{2})\.parquet")
+
+# Types a column can be cast from at ingest; anything else is schema drift
+TYPE_FAMILIES = {
+    "numeric": re.compile(r"(U?(TINY|SMALL|BIG|HUGE)?INT(EGER)?|FLOAT|DOUBLE|REAL|DECIMAL.*)"),
+    "timestamp": re.compile(r"(TIMESTAMP.*|DATE)"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def create_catalog_table(con):
+    # One row per source file; status is ok, cast (types differ but convert), drift or unreadable
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CATALOG_TABLE} (
+            dataset VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            source_file VARCHAR,
+            file_size BIGINT,
+            file_mtime DOUBLE,
+            num_rows BIGINT,
+            num_row_groups BIGINT,
+            pickup_min TIMESTAMP,
+            pickup_max TIMESTAMP,
+            column_types MAP(VARCHAR, VARCHAR),
+            status VARCHAR,
+            problems VARCHAR,
+            cataloged_at TIMESTAMP,
+            PRIMARY KEY (dataset, year, month)
+        );
+    """)
+
+
+def type_family(col_type):
+    return next((name for name, pattern in TYPE_FAMILIES.items() if pattern.fullmatch(col_type)), None)
+
+
+def check_schema(column_types, expected):
+    # expected: {column: type it is loaded as}; returns (status, problems)
+    drift, casts = [], []
+    for col, want in expected.items():
+        have = column_types.get(col)
+        if have is None:
+            drift.append(f"missing {col}")
+        elif have != want:
+            same_family = type_family(have) is not None and type_family(have) == type_family(want)
+            (casts if same_family else drift).append(f"{col} {have} -> {want}")
+    if drift:
+        return "drift", "; ".join(drift + casts)
+    return ("cast", "; ".join(casts)) if casts else ("ok", None)
+
+
+def read_footers(con, paths, pickup_col):
+    # Row counts, leaf column types and the pickup column's row group min/max, for many files in
+    # three metadata queries. Raises if any footer can't be read.
+    file_list = ", ".join(f"'{p}'" for p in paths)
+    info = {name: {"column_types": {}} for name in map(str, paths)}
+    for name, num_rows, num_row_groups in con.execute(f"""
+        SELECT file_name, num_rows, num_row_groups FROM parquet_file_metadata([{file_list}]);
+    """).fetchall():
+        info[name].update(num_rows=num_rows, num_row_groups=num_row_groups)
+    for name, col, col_type in con.execute(f"""
+        SELECT file_name, name, duckdb_type FROM parquet_schema([{file_list}])
+        WHERE num_children IS NULL;
+    """).fetchall():
+        info[name]["column_types"][col] = col_type
+    for name, pickup_min, pickup_max in query.run(con, f"""
+        SELECT file_name, MIN(TRY_CAST(stats_min_value AS TIMESTAMP)), MAX(TRY_CAST(stats_max_value AS TIMESTAMP))
+        FROM parquet_metadata([{file_list}])
+        WHERE path_in_schema = $1
+        GROUP BY 1;
+    """, [pickup_col]).fetchall():
+        info[name].update(pickup_min=pickup_min, pickup_max=pickup_max)
+    return info
+
+
+def refresh(con, dataset, candidates, pickup_col, expected):
+    """Catalogs the footers of new or changed files and returns the catalog rows for
+    candidates (list of (year, month, path)) as {(year, month): row dict}.
+
+    expected: {column: type} the ingest loads, used to classify each file's schema.
+    """
+    known = {
+        (year, month): (size, mtime)
+        for year, month, size, mtime in query.run(con, f"""
+            SELECT year, month, file_size, file_mtime FROM {CATALOG_TABLE} WHERE dataset = $1;
+        """, [dataset]).fetchall()
+    }
+    stale = [(year, month, fp) for year, month, fp in candidates
+             if known.get((year, month)) != (fp.stat().st_size, fp.stat().st_mtime)]
+
+    if stale:
+        try:
+            footers = read_footers(con, [fp for _, _, fp in stale], pickup_col)
+        except duckdb.Error as e:
+            # One bad footer fails the batch; read file by file to find it
+            logger.warning(f"[catalog] {dataset}: batch footer read failed, retrying per file: {e}")
+            footers = {}
+            for _, _, fp in stale:
+                try:
+                    footers.update(read_footers(con, [fp], pickup_col))
+                except duckdb.Error as file_error:
+                    footers[str(fp)] = {"column_types": {}, "error": str(file_error).splitlines()[0]}
+
+        for year, month, fp in stale:
+            footer = footers[str(fp)]
+            if "error" in footer:
+                status, problems = "unreadable", footer["error"]
+            else:
+                status, problems = check_schema(footer["column_types"], expected)
+            st = fp.stat()
+            query.run(con, f"""
+                INSERT OR REPLACE INTO {CATALOG_TABLE} VALUES (
+                    $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, now()::TIMESTAMP
+                );
+            """, [dataset, year, month, str(fp), st.st_size, st.st_mtime,
+                  footer.get("num_rows"), footer.get("num_row_groups"),
+                  footer.get("pickup_min"), footer.get("pickup_max"),
+                  footer["column_types"], status, problems])
+        logger.info(f"[catalog] {dataset}: read {len(stale)} footers, {len(candidates) - len(stale)} unchanged")
+
+    rows = catalog_rows(con, dataset)
+    return {(year, month): rows[(year, month)] for year, month, _ in candidates}
+
+
+def catalog_rows(con, dataset):
+    cols = ["year", "month", "source_file", "num_rows", "num_row_groups", "pickup_min", "pickup_max",
+            "status", "problems"]
+    return {
+        (row[0], row[1]): dict(zip(cols, row))
+        for row in query.run(con, f"SELECT {', '.join(cols)} FROM {CATALOG_TABLE} WHERE dataset = $1;",
+                             [dataset]).fetchall()
+    }
+
+
+def data_files(taxi):
+    # Every month file of one taxi type under DATA_DIR, as (year, month, path)
+    files = []
+    for fp in sorted(DATA_DIR.glob(f"{taxi}_tripdata_*.parquet")):
+        m = FILE_RE.fullmatch(fp.name)
+        if m:
+            files.append((int(m["year"]), int(m["month"]), fp))
+    return files
+
+
+def expected_types(cols, types):
+    # What load.py's ingest casts each source column to
+    return {cols[0]: "TIMESTAMP", cols[1]: "TIMESTAMP", **{c: types[c] for c in cols[2:]}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalog and check the footers of every parquet file under data/")
+    parser.add_argument("--db", default=str(DB_PATH), help="database holding the catalog table (default taxi.duckdb)")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+        filename='logs/catalog.log'
+    )
+    types = COMPACT_TYPES if COMPACT_SCHEMA else WIDE_TYPES
+    con = duckdb.connect(args.db)
+    try:
+        create_catalog_table(con)
+        for taxi in TAXIS:
+            cols = YELLOW_COLS if taxi == "yellow" else GREEN_COLS
+            start = time.perf_counter()
+            rows = refresh(con, taxi, data_files(taxi), cols[0], expected_types(cols, types))
+            by_status = {}
+            for row in rows.values():
+                by_status[row["status"]] = by_status.get(row["status"], 0) + 1
+            print(f"[catalog] {taxi}: {len(rows)} files, {sum(r['num_rows'] or 0 for r in rows.values()):,} rows, "
+                  f"{by_status} in {time.perf_counter() - start:.2f}s")
+            for (year, month), row in sorted(rows.items()):
+                if row["status"] in ("drift", "unreadable"):
+                    print(f"[catalog]   {year}-{month:02d} {row['status']}: {row['problems']}")
+    finally:
+        con.close()
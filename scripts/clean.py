@@ -1,15 +1,27 @@
 import duckdb
 import logging
+import shutil
+import uuid
 
+import instrument
+import lake
+import parallel
+import query
+import snapshot
+from config import (DB_PATH, STORAGE_MODE, YELLOW_TABLE, GREEN_TABLE, YELLOW_COLS, GREEN_COLS,
+                    TAXI_FOR_TABLE, MANIFEST_TABLE)
+from rules import (clean_filters, rule_counts, first_copies, earlier_months, trip_key, create_stats_table,
+                   record_stats, mark_cleaned)
 
-# Configs
-DB_PATH = "taxi.duckdb"
 
-YELLOW_TABLE = "yellow_taxi_trips"
-GREEN_TABLE  = "green_taxi_trips"
+# Configs
+CLEAN_MODE = "partitioned" # "partitioned" = one (taxi, year, month) slice at a time, "full" = whole-table rewrite
+CLEAN_MEMORY_LIMIT = "4GB" # DuckDB memory_limit while cleaning, shared by all workers; larger slices spill to disk
+CLEAN_THREADS = None # DuckDB threads while cleaning, None = one per core
+CLEAN_TEMP_DIRECTORY = None # where spills go, None = DuckDB's default next to the database
 
-YELLOW_COLS = ["tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count", "trip_distance"]
-GREEN_COLS  = ["lpep_pickup_datetime", "lpep_dropoff_datetime", "passenger_count", "trip_distance"]
+TABLE_WORKERS = 2 # taxi tables cleaned at the same time, each on its own cursor
+PARTITION_WORKERS = 1 # slices of one table cleaned at the same time
 
 # Logging
 logging.basicConfig(
@@ -18,144 +30,294 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+metrics = instrument.Instrumentation("clean")
+
+
+def dirty_partitions(con, table_name):
+    # Months loaded since they were last cleaned, per the load manifest
+    taxi = TAXI_FOR_TABLE[table_name]
+    if query.table_exists(con, MANIFEST_TABLE):
+        return query.run(con, f"""
+            SELECT year, month FROM {MANIFEST_TABLE}
+            WHERE dataset = $1 AND cleaned_at IS NULL
+            ORDER BY 1, 2;
+        """, [taxi]).fetchall()
+
+    # No manifest: treat every month present as dirty
+    return con.execute(f"""
+        SELECT DISTINCT year, month FROM {table_name} ORDER BY 1, 2;
+    """).fetchall()
+
+
+# Partition-wise clean: dedupe and filter one source month at a time.
+# Duplicates are the same trip (rules.trip_key), also when it was filed in two month files: the
+# earliest month keeps it, so a slice drops the trips an earlier slice holds. Memory stays bounded
+# by one month; the earlier slices are only probed for the trip columns.
+def clean_partition(con, table_name, year, month, pickup_col, dropoff_col, run_id, has_manifest):
+    # Cleans one (year, month) slice and returns the rows removed from it
+    taxi = TAXI_FOR_TABLE[table_name]
+    with metrics.stage("clean_partition", item=f"{table_name} {year}-{month:02d}") as m:
+        if STORAGE_MODE == "lake":
+            if not lake.partition_dir(lake.RAW_LAYER, taxi, year, month).exists():
+                return 0
+            raw_sql = lake.read_sql(lake.RAW_LAYER, taxi, year, month)
+            counts = rule_counts(con, raw_sql, pickup_col, dropoff_col)
+            clean_sql = f"SELECT * FROM ({raw_sql}) WHERE {clean_filters(pickup_col, dropoff_col)}"
+            earlier_sql = f"SELECT * FROM ({lake.read_sql(lake.RAW_LAYER, taxi)}) WHERE {earlier_months(year, month)}"
+            lake.write_partition_file(con, f"""
+                SELECT * EXCLUDE (year, month)
+                FROM ({first_copies(clean_sql, pickup_col, dropoff_col, earlier_sql)})
+            """, lake.CLEAN_LAYER, taxi, year, month)
+            rows_out = con.execute(f"""
+                SELECT COUNT(*) FROM ({lake.read_sql(lake.CLEAN_LAYER, taxi, year, month)});
+            """).fetchone()[0]
+            removed = record_stats(con, run_id, table_name, year, month, counts, rows_out)
+            if has_manifest:
+                mark_cleaned(con, table_name, year, month)
+            m["rows_in"], m["rows_out"] = counts["rows_in"], rows_out
+        else:
+            # Replace the slice in place, so the table never goes missing and
+            # extra disk use is one month rather than a second copy of the table.
+            # The per-slice statements bind (year, month); CREATE TABLE AS can't take
+            # parameters, so its values are checked ints instead.
+            table_name, year, month = query.ident(table_name), int(year), int(month)
+            con.execute("BEGIN TRANSACTION;")
+            try:
+                counts = rule_counts(con, f"""
+                    SELECT * FROM {table_name} WHERE year = $1 AND month = $2
+                """, pickup_col, dropoff_col, params=[year, month])
+                slice_sql = f"""
+                    SELECT * FROM {table_name}
+                    WHERE year = {year} AND month = {month} AND {clean_filters(pickup_col, dropoff_col)}
+                """
+                earlier_sql = f"SELECT * FROM {table_name} WHERE {earlier_months(year, month)}"
+                con.execute(f"""
+                    CREATE OR REPLACE TEMP TABLE clean_slice AS
+                    {first_copies(slice_sql, pickup_col, dropoff_col, earlier_sql)};
+                """)
+                query.run(con, f"""
+                    DELETE FROM {table_name} WHERE year = $1 AND month = $2;
+                """, [year, month])
+                con.execute(f"""
+                    INSERT INTO {table_name} SELECT * FROM clean_slice;
+                """)
+                rows_out = con.execute("SELECT COUNT(*) FROM clean_slice;").fetchone()[0]
+                removed = record_stats(con, run_id, table_name, year, month, counts, rows_out)
+                if has_manifest:
+                    mark_cleaned(con, table_name, year, month)
+                con.execute("COMMIT;")
+                m["rows_in"], m["rows_out"] = counts["rows_in"], rows_out
+            except Exception:
+                con.execute("ROLLBACK;")
+                raise
+            finally:
+                con.execute("DROP TABLE IF EXISTS clean_slice;")
+
+    logger.info(f"Cleaned {table_name} {year}-{month:02d}")
+    return removed
+
+
+def clean_partitions(con, table_name, pickup_col, dropoff_col, run_id):
+    taxi = TAXI_FOR_TABLE[table_name]
+    parallel.configure(con, CLEAN_THREADS, CLEAN_MEMORY_LIMIT, CLEAN_TEMP_DIRECTORY)
+    con.execute("SET preserve_insertion_order = false;")
+    has_manifest = query.table_exists(con, MANIFEST_TABLE)
+
+    partitions = dirty_partitions(con, table_name)
+    logger.info(f"{len(partitions)} partitions of {table_name} to clean")
+    parallel.output(f"Cleaning {len(partitions)} partitions of {table_name}...")
+
+    # Slices don't share rows, so they can run on separate cursors at the same time
+    jobs = {
+        (year, month): (lambda cur, year=year, month=month: clean_partition(
+            cur, table_name, year, month, pickup_col, dropoff_col, run_id, has_manifest))
+        for year, month in partitions
+    }
+    removed = sum(parallel.run_parallel(con, jobs, PARTITION_WORKERS, metrics).values())
+
+    if STORAGE_MODE == "lake":
+        lake.point_view(con, table_name, lake.CLEAN_LAYER, taxi)
+    return removed, partitions
+
+
+# Lake clean: rebuild lake/clean from lake/raw for one taxi, then swap it in
+def clean_lake(con, table_name, pickup_col, dropoff_col, run_id):
+    taxi = TAXI_FOR_TABLE[table_name]
+    next_layer = f"{lake.CLEAN_LAYER}_next"
+    shutil.rmtree(lake.taxi_dir(next_layer, taxi), ignore_errors=True)
+
+    raw_sql = lake.read_sql(lake.RAW_LAYER, taxi)
+    counts = rule_counts(con, raw_sql, pickup_col, dropoff_col)
+    clean_sql = f"SELECT * FROM ({raw_sql}) WHERE {clean_filters(pickup_col, dropoff_col)}"
+    lake.write_partitions(con, f"""
+        SELECT *, '{taxi}' AS taxi_type
+        FROM ({first_copies(clean_sql, pickup_col, dropoff_col)})
+    """, next_layer)
+    logger.info(f"Deduplicated and cleaned {taxi} into lake/{next_layer}")
+
+    # Swap directories and repoint the view
+    shutil.rmtree(lake.taxi_dir(lake.CLEAN_LAYER, taxi), ignore_errors=True)
+    lake.taxi_dir(lake.CLEAN_LAYER, taxi).parent.mkdir(parents=True, exist_ok=True)
+    lake.taxi_dir(next_layer, taxi).rename(lake.taxi_dir(lake.CLEAN_LAYER, taxi))
+    lake.point_view(con, table_name, lake.CLEAN_LAYER, taxi)
+    logger.info(f"Swapped in cleaned lake layer for {table_name}")
+
+    rows_out = con.execute(f"SELECT COUNT(*) FROM ({lake.read_sql(lake.CLEAN_LAYER, taxi)});").fetchone()[0]
+    return record_stats(con, run_id, table_name, None, None, counts, rows_out)
+
 
 # Clean function
-def clean_one(con, table_name, pickup_col, dropoff_col):
-    logger.info(f"Cleaning table: {table_name}")
+def clean_one(con, table_name, pickup_col, dropoff_col, run_id=None):
+    with metrics.stage("clean", item=table_name) as m:
+        count_cleaned, removed = clean_and_verify(con, table_name, pickup_col, dropoff_col, run_id)
+        m["rows_in"], m["rows_out"] = count_cleaned + removed, count_cleaned
+    return count_cleaned
 
-    # Count number of raw rows before cleaning
-    count_raw = con.execute(f"""
-                    SELECT COUNT(*) FROM {table_name};
-                """).fetchone()[0]
-    logger.info(f"[counts] Rows before: {count_raw}")
-
-
-    # Drop table if it exists
-    con.execute(f"""
-        DROP TABLE IF EXISTS {table_name}_cleaned_temp;
-    """)
-    logger.info(f"Dropped {table_name}_cleaned_temp if exists")
-
-    # Create cleaned_temp table
-    # Deduplicate
-    # Apply filters: remove trips with 0 passengers, 0 miles, >100 miles, >1 day(86400 seconds)
-    con.execute(f"""
-        CREATE TABLE {table_name}_cleaned_temp AS 
-        SELECT DISTINCT *
-        FROM {table_name}
-        WHERE passenger_count > 0
-            AND trip_distance > 0
-            AND trip_distance <= 100
-            AND date_diff('second', {pickup_col}, {dropoff_col}) <= 86400;
-    """)
-    logger.info(f"Deduplicated and cleaned {table_name}_cleaned_temp with filters")
-
-
-    # Swap tables
-    con.execute(f"""
-        DROP TABLE {table_name};
-    """)
-
-    con.execute(f"""
-        ALTER TABLE {table_name}_cleaned_temp 
-        RENAME TO {table_name};
-    """)
-    logger.info(f"Swapped in cleaned table for {table_name}")
-
-    # Count number of cleaned rows
-    count_cleaned = con.execute(f"""
-                    SELECT COUNT(*) FROM {table_name};
-                """).fetchone()[0]
-    logger.info(f"[counts] Rows after: {count_cleaned}")
-    
 
-    # Verify cleaning
+def clean_and_verify(con, table_name, pickup_col, dropoff_col, run_id=None):
+    logger.info(f"Cleaning table: {table_name}")
+    run_id = run_id or uuid.uuid4().hex
+    create_stats_table(con)
+
+    cleaned_slices = None # (year, month) slices cleaned in this run, None = the whole table
+    if CLEAN_MODE == "partitioned":
+        removed, cleaned_slices = clean_partitions(con, table_name, pickup_col, dropoff_col, run_id)
+    elif STORAGE_MODE == "lake":
+        removed = clean_lake(con, table_name, pickup_col, dropoff_col, run_id)
+    else:
+        # Drop table if it exists
+        con.execute(f"""
+            DROP TABLE IF EXISTS {table_name}_cleaned_temp;
+        """)
+        logger.info(f"Dropped {table_name}_cleaned_temp if exists")
+
+        # Count what each rule removes in the same pass that reads the raw rows
+        counts = rule_counts(con, f"SELECT * FROM {table_name}", pickup_col, dropoff_col)
+
+        # Create cleaned_temp table
+        # Deduplicate
+        # Apply filters: remove trips with 0 passengers, 0 miles, >100 miles, >1 day(86400 seconds)
+        clean_sql = f"SELECT * FROM {table_name} WHERE {clean_filters(pickup_col, dropoff_col)}"
+        con.execute(f"""
+            CREATE TABLE {table_name}_cleaned_temp AS
+            {first_copies(clean_sql, pickup_col, dropoff_col)};
+        """)
+        logger.info(f"Deduplicated and cleaned {table_name}_cleaned_temp with filters")
+        rows_out = con.execute(f"SELECT COUNT(*) FROM {table_name}_cleaned_temp;").fetchone()[0]
+
+
+        # Swap tables
+        con.execute(f"""
+            DROP TABLE {table_name};
+        """)
+
+        con.execute(f"""
+            ALTER TABLE {table_name}_cleaned_temp 
+            RENAME TO {table_name};
+        """)
+        logger.info(f"Swapped in cleaned table for {table_name}")
+        removed = record_stats(con, run_id, table_name, None, None, counts, rows_out)
+
+    if CLEAN_MODE != "partitioned" and query.table_exists(con, MANIFEST_TABLE):
+        mark_cleaned(con, table_name)
+
+
+    count_cleaned = con.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0]
+    if cleaned_slices == []:
+        # Nothing changed since the last verified run; its numbers are in clean_stats
+        logger.info(f"No partitions of {table_name} cleaned, skipping verification")
+        parallel.output(f"No partitions of {table_name} cleaned, skipping verification")
+        return count_cleaned, removed
+
+    # Verify cleaning: every check in a single aggregate pass, over the slices cleaned in this run only
     logger.info(f"Verifying cleaning on {table_name}...")
-    print(f"Verifying cleaning on {table_name}...")
-
-    # Check for duplicates
-    dupes = con.execute(f"""
-        SELECT
-          (SELECT COUNT(*) FROM {table_name})
-        - (SELECT COUNT(*) FROM (SELECT DISTINCT * FROM {table_name}) AS deduped);
-    """).fetchone()[0]
-    logger.info(f"Duplicate rows: {dupes}")
-    print(f"Duplicate rows: {dupes}")
-
-    # Check for 0 passengers
-    zero_pass = con.execute(f"""
-        SELECT COUNT(*) FROM {table_name}
-        WHERE passenger_count = 0;
-    """).fetchone()[0]
-    logger.info(f"Trips with 0 passengers: {zero_pass}")
-    print(f"Trips with 0 passengers: {zero_pass}")
-
-    # Check for 0 mile trips
-    zero_miles = con.execute(f"""
-        SELECT COUNT(*) FROM {table_name}
-        WHERE trip_distance = 0;
-    """).fetchone()[0]
-    logger.info(f"Trips with 0 miles: {zero_miles}")
-    print(f"Trips with 0 miles: {zero_miles}")
-
-    # Check for trips over 100 miles
-    over_100_miles = con.execute(f"""
-        SELECT COUNT(*) FROM {table_name}
-        WHERE trip_distance > 100;
-    """).fetchone()[0]
-    logger.info(f"Trips with over 100 miles: {over_100_miles}")
-    print(f"Trips with over 100 miles: {over_100_miles}")
-
-    # Check for trips longer than 1 day
-    over_day = con.execute(f"""
-        SELECT COUNT(*) FROM {table_name}
-        WHERE date_diff('second', {pickup_col}, {dropoff_col}) > 86400;
-    """).fetchone()[0]
-    logger.info(f"Trips over 1 day: {over_day}")
-    print(f"Trips over 1 day: {over_day}")
+
+    with metrics.stage("verify", item=table_name) as m:
+        where, params = "", []
+        if cleaned_slices is not None:
+            where, params = f"WHERE {query.months_in(1)}", query.month_params(cleaned_slices)
+        verified, dupes, zero_pass, zero_miles, over_100_miles, over_day = query.run(con, f"""
+            SELECT
+                COUNT(*),
+                COUNT(*) - COUNT(DISTINCT ({", ".join(trip_key(pickup_col, dropoff_col))})),
+                COUNT(*) FILTER (WHERE passenger_count = 0),
+                COUNT(*) FILTER (WHERE trip_distance = 0),
+                COUNT(*) FILTER (WHERE trip_distance > 100),
+                COUNT(*) FILTER (WHERE date_diff('second', {pickup_col}, {dropoff_col}) > 86400)
+            FROM {table_name}
+            {where};
+        """, params).fetchone()
+        m["rows_in"] = verified
+
+    logger.info(f"[counts] Rows before: {count_cleaned + removed}")
+    logger.info(f"[counts] Rows after: {count_cleaned}")
+    lines = [f"Verifying cleaning on {table_name}..."]
+    for label, value in (("Duplicate rows", dupes),
+                         ("Trips with 0 passengers", zero_pass),
+                         ("Trips with 0 miles", zero_miles),
+                         ("Trips with over 100 miles", over_100_miles),
+                         ("Trips over 1 day", over_day)):
+        logger.info(f"{label}: {value}")
+        lines.append(f"{label}: {value}")
     logger.info(f"Done verifying {table_name}")
-    print(f"Done verifying {table_name}")
+    lines.append(f"Done verifying {table_name}")
+    parallel.output(*lines)
+    return count_cleaned, removed
 
 
-def clean_tables():
+# Returns True on success; pass con to reuse an open connection (left open afterwards)
+def clean_tables(con=None):
+    global metrics
+    metrics = instrument.Instrumentation("clean")
 
-    con = None
+    own_con = con is None
 
     try:
 
         logger.info("------ New run ---------------")
         # Connect to local duckdb
-        con = duckdb.connect(database= DB_PATH, read_only = False)
-
-        # Yellow table
-        clean_one(
-            con,
-            table_name = YELLOW_TABLE,
-            pickup_col = YELLOW_COLS[0],
-            dropoff_col= YELLOW_COLS[1]
-        )
-
-        # Green table
-        clean_one(
-            con,
-            table_name = GREEN_TABLE,
-            pickup_col = GREEN_COLS[0],
-            dropoff_col= GREEN_COLS[1]
-        )
+        if own_con:
+            con = duckdb.connect(database= str(DB_PATH), read_only = False)
+        con = metrics.wrap(con)
+
+        run_id = metrics.run_id
+        logger.info(f"Run id: {run_id}")
+        parallel.configure(con, CLEAN_THREADS, CLEAN_MEMORY_LIMIT, CLEAN_TEMP_DIRECTORY)
+        create_stats_table(con)
+
+        # Yellow and green tables are independent, so they are cleaned side by side
+        cleaned = parallel.run_parallel(con, {
+            YELLOW_TABLE: lambda cur: clean_one(
+                cur,
+                table_name = YELLOW_TABLE,
+                pickup_col = YELLOW_COLS[0],
+                dropoff_col= YELLOW_COLS[1],
+                run_id     = run_id
+            ),
+            GREEN_TABLE: lambda cur: clean_one(
+                cur,
+                table_name = GREEN_TABLE,
+                pickup_col = GREEN_COLS[0],
+                dropoff_col= GREEN_COLS[1],
+                run_id     = run_id
+            ),
+        }, TABLE_WORKERS, metrics)
+
+        # Reclaim the space freed by the deletes, once no cleaner is writing
+        if STORAGE_MODE != "lake":
+            con.execute("CHECKPOINT;")
 
         # Final cleaned counts
-        yellow_cleaned = con.execute(f"""
-                        SELECT COUNT(*) FROM {YELLOW_TABLE};
-                    """).fetchone()[0]
-        green_cleaned = con.execute(f"""
-                        SELECT COUNT(*) FROM {GREEN_TABLE};
-                    """).fetchone()[0]
-        logger.info(f"Final cleaned row counts - Yellow: {yellow_cleaned} | Green: {green_cleaned}")
+        logger.info(f"Final cleaned row counts - Yellow: {cleaned[YELLOW_TABLE]} | Green: {cleaned[GREEN_TABLE]}")
+        snapshot.record_live_version(con)
+        metrics.finish(con)
+        return True
 
     except Exception as e: 
         logger.error(f"An error occurred: {e}")
+        return False
     finally: 
-        if con is not None:
+        if own_con and con is not None:
             con.close()
 
 
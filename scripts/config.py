@@ -0,0 +1,67 @@
+from pathlib import Path
+
+
+# Settings shared by load.py, clean.py, analysis.py and pipeline.py
+DB_PATH = Path("taxi.duckdb")
+DATA_DIR = Path("data")
+EMISSIONS_CSV = DATA_DIR / "vehicle_emissions.csv"
+
+YEARS = ["2015", "2016", "2017", "2018", "2019", "2020", "2021", "2022", "2023", "2024"]
+MONTHS = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"]
+TAXIS = ["yellow", "green"]
+
+STORAGE_MODE = "duckdb" # "duckdb" = trip tables inside taxi.duckdb, "lake" = hive-partitioned parquet under lake/
+COMPACT_SCHEMA = False # narrow column types below for trip tables and dbt models (dbt var compact_schema)
+
+# Tables written by load.py and clean.py
+YELLOW_TABLE = "yellow_taxi_trips"
+GREEN_TABLE = "green_taxi_trips"
+EMISSIONS_TABLE = "vehicle_emissions"
+MANIFEST_TABLE = "ingest_manifest"
+STATS_TABLE = "clean_stats"
+QUARANTINE_TABLE = "rejected_trips"
+CATALOG_TABLE = "parquet_catalog"
+TAXI_FOR_TABLE = {YELLOW_TABLE: "yellow", GREEN_TABLE: "green"}
+
+YELLOW_COLS = ["tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count", "trip_distance"]
+GREEN_COLS  = ["lpep_pickup_datetime", "lpep_dropoff_datetime", "passenger_count", "trip_distance"]
+
+# dbt models read by analysis.py
+STG_YELLOW = "stg_yellow"
+STG_GREEN  = "stg_green"
+FCT_TRIPS  = "fct_trips_co2"
+CO2_ROLLUP = "co2_rollup"
+TRIP_SKETCHES = "trip_sketches"
+DBT_RUNS_TABLE = "dbt_runs" # one row per model built, written by dbt's on-run-end hook (macros/record_dbt_run.sql)
+
+SKETCH_ACCURACY = 0.01 # relative error of quantiles read from trip_sketches (dbt var sketch_relative_accuracy)
+
+# Column types for the default and the compact schema. load.py uses the trip table columns;
+# the dbt models cast the same way when compact_schema is set (macros/compact.sql).
+# year/month stay INTEGER: they are constant per row group, so narrowing them saves nothing.
+WIDE_TYPES = {
+    "passenger_count": "INTEGER",
+    "trip_distance": "DOUBLE",
+    "taxi_type": "VARCHAR",
+    "vehicle_type": "VARCHAR",
+    "hour_of_day": "BIGINT",
+    "day_of_week": "BIGINT",
+    "week_of_year": "BIGINT",
+    "month_of_year": "BIGINT",
+    "trip_hours": "DOUBLE",
+    "avg_mph": "DOUBLE",
+    "trip_co2_kgs": "DOUBLE",
+}
+COMPACT_TYPES = {
+    "passenger_count": "SMALLINT", # raw files have some junk counts, so not TINYINT
+    "trip_distance": "FLOAT",      # miles to 2 decimals, well within FLOAT's 7 digits
+    "taxi_type": "ENUM('yellow', 'green')",
+    "vehicle_type": "ENUM('yellow_taxi', 'green_taxi')",
+    "hour_of_day": "TINYINT",
+    "day_of_week": "TINYINT",
+    "week_of_year": "TINYINT",
+    "month_of_year": "TINYINT",
+    "trip_hours": "FLOAT",
+    "avg_mph": "FLOAT",
+    "trip_co2_kgs": "FLOAT",
+}
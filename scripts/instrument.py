@@ -0,0 +1,242 @@
+import heapq
+import json
+import logging
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import pyarrow as pa
+
+
+# Configs
+METRICS_PATH = Path("logs/metrics.jsonl")
+PROFILE_DIR = Path("logs/profiles")
+RUNS_TABLE = "pipeline_runs"
+
+PROFILE_SLOWEST = 0 # keep DuckDB's EXPLAIN ANALYZE-style JSON profile for the N slowest queries per run (0 = off)
+
+logger = logging.getLogger(__name__)
+
+
+def is_read_only(con):
+    return con.execute("""
+        SELECT readonly FROM duckdb_databases() WHERE database_name = current_database();
+    """).fetchone()[0]
+
+
+class InstrumentedConnection:
+    """Wraps a DuckDB connection so every statement's profile feeds the open stages.
+
+    DuckDB keeps the profile of the last finished query (latency, peak buffer
+    memory, bytes read, rows scanned). DML is finished when execute() returns;
+    a SELECT only once its result is fully fetched, so execute() returns the
+    wrapper and the fetch methods collect the profile afterwards.
+    """
+
+    def __init__(self, con, instrumentation):
+        self._con = con
+        self._instr = instrumentation
+        self._pending = False
+        con.execute("PRAGMA enable_profiling = 'no_output';")
+
+    def execute(self, sql, *args, **kwargs):
+        self._con.execute(sql, *args, **kwargs)
+        self._pending = True
+        self.collect()
+        return self
+
+    def fetchone(self):
+        # The scripts only fetchone single-row aggregates; drain the rest so the query finishes
+        row = self._con.fetchone()
+        self._con.fetchall()
+        self.collect()
+        return row
+
+    def fetchall(self):
+        rows = self._con.fetchall()
+        self.collect()
+        return rows
+
+    def df(self):
+        frame = self._con.df()
+        self.collect()
+        return frame
+
+    def to_arrow_table(self):
+        table = self._con.to_arrow_table()
+        self.collect()
+        return table
+
+    def to_arrow_reader(self, batch_size=1_000_000):
+        # The query only finishes with its last batch, so the profile is collected when the stream ends.
+        # Nothing else may run on this connection until then.
+        reader = self._con.to_arrow_reader(batch_size)
+
+        def batches():
+            yield from reader
+            self.collect()
+
+        return pa.RecordBatchReader.from_batches(reader.schema, batches())
+
+    def cursor(self):
+        return self._instr.wrap(self._con.cursor())
+
+    def collect(self):
+        # Fold in the last query's profile once it has finished
+        if not self._pending:
+            return
+        try:
+            profile = json.loads(self._con.get_profiling_information(format="json"))
+        except Exception:
+            return
+        if not profile.get("query_name"):
+            return
+        self._pending = False
+        self._instr.add_profile(profile)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+class Instrumentation:
+    """Per-run stage timings, row counts, bytes read and memory for one script.
+
+    Each stage is written as a JSON line to logs/metrics.jsonl when it ends and
+    saved to the pipeline_runs table by finish().
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.run_id = uuid.uuid4().hex
+        self.records = []
+        self.saved = 0  # records already in pipeline_runs
+        self.local = threading.local()  # open stages, per thread
+        self.lock = threading.Lock()
+        self.slowest = []  # heap of (latency, seq, profile)
+        self.seq = 0
+
+    def wrap(self, con):
+        return InstrumentedConnection(con, self)
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def current_stack(self):
+        return list(self.stack)
+
+    def adopt(self, parents):
+        # A worker thread's stages nest under the stages open in the thread that started it
+        self.local.stack = list(parents or [])
+
+    @contextmanager
+    def stage(self, name, item=None, rows_in=None, bytes_read=0):
+        # item names the per-file or per-partition step inside a stage, e.g. "2024-01"
+        rec = {
+            "run_id": self.run_id,
+            "script": self.script,
+            "stage": name,
+            "item": item,
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "wall_s": None,
+            "rows_in": rows_in,
+            "rows_out": None,
+            "rows_scanned": 0,
+            "bytes_read": bytes_read,
+            "duckdb_peak_bytes": 0,
+            "peak_rss_bytes": None,
+            "queries": 0,
+            "status": "ok",
+            "error": None,
+        }
+        # Source bytes the caller knows about (e.g. parquet file sizes) count for the enclosing stages too
+        with self.lock:
+            for parent in self.stack:
+                parent["bytes_read"] += bytes_read
+        self.stack.append(rec)
+        start = time.perf_counter()
+        try:
+            yield rec
+        except Exception as e:
+            rec["status"] = "error"
+            rec["error"] = str(e)
+            raise
+        finally:
+            self.stack.remove(rec)
+            rec["wall_s"] = round(time.perf_counter() - start, 3)
+            # ru_maxrss is KiB on Linux; it is the process peak so far, not per stage
+            rec["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            with self.lock:
+                self.records.append(rec)
+                self.write_line(rec)
+
+    def add_profile(self, profile):
+        # Fold one query profile into every open stage of the calling thread
+        with self.lock:
+            for rec in self.stack:
+                rec["queries"] += 1
+                rec["rows_scanned"] += profile.get("cumulative_rows_scanned", 0) or 0
+                rec["bytes_read"] += profile.get("total_bytes_read", 0) or 0
+                rec["duckdb_peak_bytes"] = max(rec["duckdb_peak_bytes"],
+                                               profile.get("system_peak_buffer_memory", 0) or 0)
+
+            if PROFILE_SLOWEST > 0:
+                self.seq += 1
+                entry = (profile.get("latency", 0.0) or 0.0, self.seq, profile)
+                if len(self.slowest) < PROFILE_SLOWEST:
+                    heapq.heappush(self.slowest, entry)
+                else:
+                    heapq.heappushpop(self.slowest, entry)
+
+    def write_line(self, rec):
+        METRICS_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(METRICS_PATH, "a") as f:
+            f.write(json.dumps(rec) + "\n")
+        logger.info(f"[metrics] {rec['stage']}{' ' + rec['item'] if rec['item'] else ''}: "
+                    f"{rec['wall_s']}s rows_in={rec['rows_in']} rows_out={rec['rows_out']} "
+                    f"peak={rec['duckdb_peak_bytes']}")
+
+    def finish(self, con):
+        # Save this run's new stages to pipeline_runs and the slowest query profiles to logs/profiles.
+        # A read-only connection (a published snapshot) keeps them in logs/metrics.jsonl only.
+        new = self.records[self.saved:]
+        if con is not None and new and not is_read_only(con):
+            con.execute(f"""
+                CREATE TABLE IF NOT EXISTS {RUNS_TABLE} (
+                    run_id VARCHAR,
+                    script VARCHAR,
+                    stage VARCHAR,
+                    item VARCHAR,
+                    started_at TIMESTAMP,
+                    wall_s DOUBLE,
+                    rows_in BIGINT,
+                    rows_out BIGINT,
+                    rows_scanned BIGINT,
+                    bytes_read BIGINT,
+                    duckdb_peak_bytes BIGINT,
+                    peak_rss_bytes BIGINT,
+                    queries INTEGER,
+                    status VARCHAR,
+                    error VARCHAR
+                );
+            """)
+            cols = list(new[0].keys())
+            con.executemany(
+                f"INSERT INTO {RUNS_TABLE} ({', '.join(cols)}) VALUES ({', '.join('?' for _ in cols)});",
+                [[rec[c] for c in cols] for rec in new],
+            )
+            self.saved = len(self.records)
+
+        if self.slowest:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            for rank, (latency, _, profile) in enumerate(sorted(self.slowest, reverse=True), start=1):
+                out = PROFILE_DIR / f"{self.script}_{self.run_id}_{rank}.json"
+                out.write_text(json.dumps(profile, indent=2))
+                logger.info(f"[metrics] profile #{rank} ({latency:.2f}s) saved to {out}")
+            self.slowest = []
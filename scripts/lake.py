@@ -0,0 +1,89 @@
+import logging
+import shutil
+from pathlib import Path
+
+
+# Configs
+LAKE_DIR = Path("lake")
+COMPRESSION = "zstd"
+
+RAW_LAYER = "raw"
+CLEAN_LAYER = "clean"
+
+logger = logging.getLogger(__name__)
+
+
+# Layout: lake/<layer>/taxi_type=<taxi>/year=<yyyy>/month=<m>/data_0.parquet
+def taxi_dir(layer, taxi):
+    return LAKE_DIR / layer / f"taxi_type={taxi}"
+
+
+def partition_dir(layer, taxi, year, month):
+    return taxi_dir(layer, taxi) / f"year={int(year)}" / f"month={int(month)}"
+
+
+def taxi_glob(layer, taxi):
+    return f"{taxi_dir(layer, taxi).resolve()}/*/*/*.parquet"
+
+
+def has_files(layer, taxi):
+    return any(taxi_dir(layer, taxi).glob("*/*/*.parquet"))
+
+
+def drop_partitions(layer, taxi, months):
+    # months: iterable of (year, month)
+    for year, month in months:
+        shutil.rmtree(partition_dir(layer, taxi, year, month), ignore_errors=True)
+
+
+def write_partitions(con, select_sql, layer):
+    # select_sql must return a taxi_type, year and month column to partition on
+    out = LAKE_DIR / layer
+    out.mkdir(parents=True, exist_ok=True)
+    con.execute(f"""
+        COPY ({select_sql})
+        TO '{out}' (
+            FORMAT parquet,
+            PARTITION_BY (taxi_type, year, month),
+            COMPRESSION {COMPRESSION},
+            OVERWRITE_OR_IGNORE true
+        );
+    """)
+
+
+def write_partition_file(con, select_sql, layer, taxi, year, month):
+    # Replace one partition with a single file; select_sql must not return the hive columns
+    out_dir = partition_dir(layer, taxi, year, month)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    tmp = out_dir.parent / f".month={int(month)}.parquet.tmp"
+    con.execute(f"""
+        COPY ({select_sql})
+        TO '{tmp}' (FORMAT parquet, COMPRESSION {COMPRESSION});
+    """)
+    for old in out_dir.glob("*.parquet"):
+        old.unlink()
+    tmp.replace(out_dir / "data_0.parquet")
+
+
+def read_sql(layer, taxi, year=None, month=None):
+    # Hive columns come back as year/month INTEGER so filters on them prune directories
+    path = taxi_glob(layer, taxi)
+    if year is not None:
+        path = f"{partition_dir(layer, taxi, year, month).resolve()}/*.parquet"
+    return f"""
+        SELECT * EXCLUDE (taxi_type)
+        FROM read_parquet('{path}',
+            hive_partitioning = true,
+            hive_types = {{'year': INTEGER, 'month': INTEGER}})
+    """
+
+
+def point_view(con, view, layer, taxi):
+    # Expose one layer of the lake under the usual table name for dbt and analysis
+    if not has_files(layer, taxi):
+        logger.warning(f"[lake] no {layer} files for {taxi}, leaving {view} as is")
+        return
+    con.execute(f"""
+        CREATE OR REPLACE VIEW {view} AS {read_sql(layer, taxi)};
+    """)
+    logger.info(f"[lake] {view} -> {taxi_dir(layer, taxi)}")
@@ -1,30 +1,45 @@
 import duckdb
 import requests 
 
+import hashlib
 import logging
+import os
+import shutil
+import threading
 import time
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
 
+import catalog
+import instrument
+import lake
+import parallel
+import query
+import rules
+import snapshot
+from config import (DB_PATH, DATA_DIR, EMISSIONS_CSV, YEARS, MONTHS, TAXIS, STORAGE_MODE, COMPACT_SCHEMA,
+                    WIDE_TYPES, COMPACT_TYPES, YELLOW_TABLE, GREEN_TABLE, EMISSIONS_TABLE, MANIFEST_TABLE,
+                    CATALOG_TABLE, YELLOW_COLS, GREEN_COLS)
 
-# Configs
-YEARS = ["2015", "2016", "2017", "2018", "2019", "2020", "2021", "2022", "2023", "2024"]
-MONTHS = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10", "11", "12"] 
-TAXIS = ["yellow", "green"]
 
+# Configs
 BASE_URL = "https://d37ci6vzurychx.cloudfront.net/trip-data/{taxi}_tripdata_{year}-{month}.parquet"
 
-DATA_DIR = Path("data")
-DB_PATH = Path("taxi.duckdb")
-EMISSIONS_CSV = DATA_DIR / "vehicle_emissions.csv" 
-
-DOWNLOAD_DELAY = 2.0 # seconds
+DOWNLOAD_WORKERS = 4
+HOST_MIN_INTERVAL = 0.5 # seconds between request starts to the same host
+DOWNLOAD_RETRIES = 3
+CHUNK_SIZE = 1 << 20
+PARQUET_MAGIC = b"PAR1"
 
-YELLOW_TABLE = "yellow_taxi_trips"
-GREEN_TABLE = "green_taxi_trips"
-EMISSIONS_TABLE = "vehicle_emissions"
+INGEST_MODE = "bulk" # "bulk" = one multi-file scan per taxi, "per_file" = one INSERT per month
+FULL_RELOAD = False # True drops everything and re-ingests, False only loads new or changed months
+INGEST_CLEAN = False # True applies clean.py's rules and dedupe during ingest, so clean.py has nothing left to do
+REJECTS = "counts" # with INGEST_CLEAN: "counts" = per-rule counts in clean_stats, "quarantine" = also keep rejected rows
 
-YELLOW_COLS = ["tpep_pickup_datetime", "tpep_dropoff_datetime", "passenger_count", "trip_distance"]
-GREEN_COLS  = ["lpep_pickup_datetime", "lpep_dropoff_datetime", "passenger_count", "trip_distance"]
+INGEST_WORKERS = 2 # taxi types ingested at the same time, each on its own cursor
+LOAD_THREADS = None # DuckDB threads while loading, None = one per core
+LOAD_MEMORY_LIMIT = None # DuckDB memory_limit while loading, shared by all workers, None = DuckDB default
+LOAD_TEMP_DIRECTORY = None # where spills go, None = DuckDB's default next to the database
 
 
 # Logging
@@ -35,151 +50,634 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.info("---------New run-----------------")
 
+metrics = instrument.Instrumentation("load")
 
-# Load function
-def load_parquet_files():
 
-    con = None
+# Download helpers
+class HostRateLimiter:
+    """Spaces out request starts per host, shared by all download workers."""
+
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
 
+
+_thread_state = threading.local()
+
+def get_session():
+    # One keep-alive session per worker thread
+    if not hasattr(_thread_state, "session"):
+        _thread_state.session = requests.Session()
+    return _thread_state.session
+
+
+def parquet_file_ok(path, expected_size=None):
+    # Check size, leading/trailing PAR1 magic and a sane footer length
     try:
-        # Download needed parquet files 
-        DATA_DIR.mkdir(parents = True, exist_ok = True)
-
-        # Loop over yellow and green taxis
-        for taxi in TAXIS:
-            # Loop over each year 
-            for year in YEARS:
-                print(f'Downloading data for {year}')
-                # Loop over each month
-                for month in MONTHS:
-                    url= BASE_URL.format(taxi = taxi, year =year, month=month) 
-                    out= DATA_DIR / f'{taxi}_tripdata_{year}-{month}.parquet'
-
-                    # Don't download if parquet file already exists 
-                    if out.exists():
-                        logger.info(f"[download] exists, skip {out.name}")
-                        continue
-
-                    # Get parquet from cloudfront
-                    logger.info(f'[download] GET {url} FOR {out.name}')
-                    try:
-                        with requests.get(url, stream= True, timeout= (10, 60)) as r :
-                            r.raise_for_status()
-                            with open(out, "wb") as f:
-                                for chunk in r.iter_content(chunk_size=1 << 20):
-                                    if chunk:
-                                        f.write(chunk)
-                        # Space out to avoid error
-                        time.sleep(DOWNLOAD_DELAY)
-                    except Exception as e:
-                        logger.error(f'[download] failed for {out.name}: {e}')   
-                
+        size = path.stat().st_size
+    except FileNotFoundError:
+        return False
+    if expected_size is not None and size != expected_size:
+        return False
+    if size < 12:
+        return False
+
+    with open(path, "rb") as f:
+        head = f.read(4)
+        f.seek(-8, os.SEEK_END)
+        tail = f.read(8)
+
+    footer_len = int.from_bytes(tail[:4], "little")
+    return head == PARQUET_MAGIC and tail[4:] == PARQUET_MAGIC and 0 < footer_len <= size - 12
+
+
+def total_size_from(r):
+    # Full object size from Content-Range (206) or Content-Length (200)
+    if r.status_code == 206:
+        total = r.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+    else:
+        total = r.headers.get("Content-Length", "")
+    return int(total) if total.isdigit() else None
+
+
+def download_one(url, out, limiter):
+    # Valid files are done; anything else is resumed or fetched
+    if parquet_file_ok(out):
+        logger.info(f"[download] exists, skip {out.name}")
+        return "exists"
+
+    part = out.with_name(out.name + ".part")
+    if out.exists():
+        logger.warning(f"[download] {out.name} is truncated or corrupt, resuming it")
+        os.replace(out, part)
+
+    for attempt in range(1, DOWNLOAD_RETRIES + 1):
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        limiter.wait(url)
+        logger.info(f"[download] GET {url} FOR {out.name} (offset {offset}, attempt {attempt})")
+        try:
+            with get_session().get(url, headers=headers, stream=True, timeout=(10, 60)) as r:
+                if r.status_code == 404:
+                    logger.error(f"[download] not published: {out.name}")
+                    return "missing"
+
+                # Partial file already holds every byte
+                if r.status_code == 416:
+                    total = int(r.headers.get("Content-Range", "*/0").rsplit("/", 1)[-1] or 0)
+                else:
+                    r.raise_for_status()
+                    total = total_size_from(r)
+                    # Server ignored the range, so start over
+                    mode = "ab" if r.status_code == 206 else "wb"
+                    with open(part, mode) as f:
+                        for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                            if chunk:
+                                f.write(chunk)
+
+            if parquet_file_ok(part, total):
+                os.replace(part, out)
+                logger.info(f"[download] OK {out.name} ({out.stat().st_size} bytes)")
+                return "downloaded"
+
+            logger.error(f"[download] {out.name} failed size/footer check, discarding partial file")
+            part.unlink(missing_ok=True)
+
+        except (requests.RequestException, OSError) as e:
+            logger.warning(f"[download] attempt {attempt} failed for {out.name}: {e}")
+            time.sleep(2 ** attempt)
+
+    logger.error(f"[download] failed for {out.name} after {DOWNLOAD_RETRIES} attempts")
+    return "failed"
+
+
+def download_files():
+    DATA_DIR.mkdir(parents = True, exist_ok = True)
+    limiter = HostRateLimiter(HOST_MIN_INTERVAL)
+
+    jobs = {}
+    for taxi in TAXIS:
+        for year in YEARS:
+            for month in MONTHS:
+                url = BASE_URL.format(taxi = taxi, year = year, month = month)
+                out = DATA_DIR / f'{taxi}_tripdata_{year}-{month}.parquet'
+                jobs[out.name] = (url, out)
+
+    print(f"Downloading {len(jobs)} files with {DOWNLOAD_WORKERS} workers...")
+    results = {}
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+        futures = {pool.submit(download_one, url, out, limiter): name for name, (url, out) in jobs.items()}
+        for fut in as_completed(futures):
+            name = futures[fut]
+            try:
+                results[name] = fut.result()
+            except Exception as e:
+                logger.error(f"[download] unexpected error for {name}: {e}")
+                results[name] = "failed"
+
+    summary = {status: sum(1 for r in results.values() if r == status)
+               for status in ("downloaded", "exists", "missing", "failed")}
+    logger.info(f"[download] summary {summary}")
+    print(f"Download summary: {summary}")
+    return results
+
+
+# Manifest helpers
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def create_tables(con):
+    # Trip tables are views over the lake in lake mode, real tables otherwise
+    existing = dict(query.run(con, """
+        SELECT table_name, table_type FROM information_schema.tables
+        WHERE table_name IN ($1, $2);
+    """, [YELLOW_TABLE, GREEN_TABLE]).fetchall())
+    has_lineage = query.run(con, """
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_name = $1 AND column_name = $2;
+    """, [YELLOW_TABLE, "source_file"]).fetchone()[0] > 0
+
+    # Tables from before the lineage columns existed can't be reloaded per month,
+    # and switching storage modes leaves the manifest describing the other store
+    wanted_type = "VIEW" if STORAGE_MODE == "lake" else "BASE TABLE"
+    stale = bool(existing) and (not has_lineage or any(t != wanted_type for t in existing.values()))
+
+    if FULL_RELOAD or stale:
+        for table in (YELLOW_TABLE, GREEN_TABLE):
+            if table in existing:
+                kind = "VIEW" if existing[table] == "VIEW" else "TABLE"
+                con.execute(f"""
+                    DROP {kind} IF EXISTS {table};
+                """)
+        for table in (EMISSIONS_TABLE, MANIFEST_TABLE):
+            con.execute(f"""
+                DROP TABLE IF EXISTS {table};
+            """)
+        if STORAGE_MODE == "lake":
+            for taxi in TAXIS:
+                for layer in (lake.RAW_LAYER, lake.CLEAN_LAYER):
+                    shutil.rmtree(lake.taxi_dir(layer, taxi), ignore_errors=True)
+        logger.info("Dropped trip, emissions and manifest tables for a full reload")
+        print("Full reload: dropped existing tables")
+
+    # One row per source file (emissions CSV uses year = month = 0)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MANIFEST_TABLE} (
+            dataset VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            source_file VARCHAR,
+            file_size BIGINT,
+            file_mtime DOUBLE,
+            content_hash VARCHAR,
+            row_count BIGINT,
+            loaded_at TIMESTAMP,
+            cleaned_at TIMESTAMP,
+            PRIMARY KEY (dataset, year, month)
+        );
+    """)
+    con.execute(f"""
+        ALTER TABLE {MANIFEST_TABLE} ADD COLUMN IF NOT EXISTS cleaned_at TIMESTAMP;
+    """)
+
+    catalog.create_catalog_table(con)
+
+    # Fused ingest writes clean.py's stats itself; created here so parallel taxi workers don't race on it
+    if INGEST_CLEAN:
+        rules.create_stats_table(con)
+        if REJECTS == "quarantine":
+            rules.create_quarantine_table(con)
+
+    if STORAGE_MODE == "lake":
+        logger.info("Created manifest table; trip views are created after ingest")
+        return
+
+    # Create tables with necessary columns
+    types = trip_types()
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {YELLOW_TABLE} (
+            tpep_pickup_datetime TIMESTAMP,
+            tpep_dropoff_datetime TIMESTAMP,
+            passenger_count {types["passenger_count"]},
+            trip_distance {types["trip_distance"]},
+            source_file VARCHAR,
+            year INTEGER,
+            month INTEGER
+        );
+    """)
+
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {GREEN_TABLE} (
+            lpep_pickup_datetime TIMESTAMP,
+            lpep_dropoff_datetime TIMESTAMP,
+            passenger_count {types["passenger_count"]},
+            trip_distance {types["trip_distance"]},
+            source_file VARCHAR,
+            year INTEGER,
+            month INTEGER
+        );
+    """)
+
+    # Tables created under the other COMPACT_SCHEMA setting are converted in place
+    for table in (YELLOW_TABLE, GREEN_TABLE):
+        align_types(con, table, types)
+
+    logger.info("Created trip and manifest tables if not exists")
+
+
+def trip_types():
+    return COMPACT_TYPES if COMPACT_SCHEMA else WIDE_TYPES
+
+
+def align_types(con, table, types):
+    current = dict(query.run(con, """
+        SELECT column_name, data_type FROM information_schema.columns WHERE table_name = $1;
+    """, [table]).fetchall())
+    for col, col_type in types.items():
+        if col in current and current[col] != col_type:
+            con.execute(f"""
+                ALTER TABLE {table} ALTER COLUMN {col} TYPE {col_type};
+            """)
+            logger.info(f"Changed {table}.{col} from {current[col]} to {col_type}")
+
+
+def plan_changes(con, dataset, candidates):
+    # candidates: list of (year, month, path); returns the entries whose source is new or changed
+    known = {
+        (year, month): (size, mtime, digest)
+        for year, month, size, mtime, digest in query.run(con, f"""
+            SELECT year, month, file_size, file_mtime, content_hash
+            FROM {MANIFEST_TABLE} WHERE dataset = $1;
+        """, [dataset]).fetchall()
+    }
+
+    changed = []
+    for year, month, fp in candidates:
+        st = fp.stat()
+        prev = known.get((year, month))
+
+        # Same size and mtime: trust it without hashing
+        if prev and prev[0] == st.st_size and prev[1] == st.st_mtime:
+            continue
+
+        digest = file_hash(fp)
+        if prev and prev[2] == digest:
+            # Touched but identical content, just record the new mtime
+            query.run(con, f"""
+                UPDATE {MANIFEST_TABLE} SET file_mtime = $1
+                WHERE dataset = $2 AND year = $3 AND month = $4;
+            """, [st.st_mtime, dataset, year, month])
+            continue
+
+        changed.append({"year": year, "month": month, "path": fp,
+                        "size": st.st_size, "mtime": st.st_mtime, "hash": digest})
+    return changed
+
+
+def record_manifest(con, dataset, entry, row_count):
+    # Resetting cleaned_at marks the partition for clean.py (INSERT OR REPLACE only
+    # overwrites the listed columns, so it has to be listed explicitly)
+    query.run(con, f"""
+        INSERT OR REPLACE INTO {MANIFEST_TABLE}
+            (dataset, year, month, source_file, file_size, file_mtime, content_hash, row_count, loaded_at, cleaned_at)
+        VALUES ($1, $2, $3, $4, $5, $6, $7, $8, now()::TIMESTAMP, NULL);
+    """, [dataset, entry["year"], entry["month"], str(entry["path"]),
+          entry["size"], entry["mtime"], entry["hash"], row_count])
+
+
+# Ingest helpers
+def ingest_select(cols, files, taxi=None):
+    # One read_parquet scan over the given files, tagging each row with its source file, year and month.
+    # Columns are cast to the schema's types here (the types the catalog checks files against),
+    # so lake files get them too and files the catalog marked "cast" load like the rest.
+    file_list = ", ".join(f"'{fp}'" for fp in files)
+    types = catalog.expected_types(cols, trip_types())
+    cols = [f"CAST({c} AS {types[c]}) AS {c}" for c in cols]
+    taxi_col = f"'{taxi}' AS taxi_type," if taxi else ""
+    return f"""
+        SELECT {", ".join(cols)}, {taxi_col}
+            filename AS source_file,
+            CAST(regexp_extract(filename, '(\\d{{4}})-(\\d{{2}})\\.parquet$', 1) AS INTEGER) AS year,
+            CAST(regexp_extract(filename, '(\\d{{4}})-(\\d{{2}})\\.parquet$', 2) AS INTEGER) AS month
+        FROM read_parquet([{file_list}], union_by_name = true, filename = true)
+    """
+
+
+def fused_select(cols, files, taxi=None, earlier_sql=None):
+    # The ingest scan with clean.py's rules and dedupe applied (earlier_sql: rows of the months before
+    # these, see rules.first_copies). The filters sit directly on the read_parquet scan, so DuckDB
+    # pushes them into it (and skips row groups whose stats rule them out)
+    clean_sql = f"""
+        SELECT *
+        FROM ({ingest_select(cols, files)}) AS src
+        WHERE {rules.clean_filters(cols[0], cols[1])}
+    """
+    taxi_col = f", '{taxi}' AS taxi_type" if taxi else ""
+    return f"""
+        SELECT *{taxi_col}
+        FROM ({rules.first_copies(clean_sql, cols[0], cols[1], earlier_sql)})
+    """
+
+
+def ingest_statement(table, cols, files, earlier_sql=None):
+    select_sql = fused_select(cols, files, earlier_sql=earlier_sql) if INGEST_CLEAN else ingest_select(cols, files)
+    return f"""
+        INSERT INTO {table}
+        {select_sql};
+    """
+
+
+def audit_rejects(con, taxi, cols, files, months):
+    # Per-month rule counts over the raw rows, plus the rejected rows themselves with REJECTS = "quarantine".
+    # An aggregate over four columns, so much cheaper than writing the raw rows and scanning them again.
+    raw_sql = ingest_select(cols, files)
+    counts = rules.rule_counts(con, raw_sql, cols[0], cols[1], by_month=True)
+    if REJECTS == "quarantine":
+        kept = rules.quarantine(con, taxi, raw_sql, cols[0], cols[1], months)
+        logger.info(f"[ingest] {taxi}: {kept} rejected rows quarantined")
+    return counts
+
+
+def record_ingest_clean(con, table, entries, counts, rows_out):
+    # clean.py's bookkeeping for months cleaned on the way in; cleaned_at tells clean.py and dbt about them
+    for e in entries:
+        key = (e["year"], e["month"])
+        rules.record_stats(con, metrics.run_id, table, e["year"], e["month"],
+                           counts.get(key, dict.fromkeys(rules.RULE_KEYS, 0)), rows_out.get(key, 0))
+        rules.mark_cleaned(con, table, e["year"], e["month"])
+
+
+def replace_partitions(con, dataset, table, cols, entries):
+    # Delete the changed months, re-insert them and update the manifest in one transaction
+    months = query.month_params([(e["year"], e["month"]) for e in entries])
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        query.run(con, f"""
+            DELETE FROM {table} WHERE {query.months_in(1)};
+        """, months)
+        earlier_sql = None
+        if INGEST_CLEAN:
+            rejects = audit_rejects(con, dataset, cols, [e["path"] for e in entries],
+                                    [(e["year"], e["month"]) for e in entries])
+            # Fused ingest goes a month at a time; its trips already in earlier months are dropped
+            first = min((e["year"], e["month"]) for e in entries)
+            earlier_sql = f"SELECT * FROM {table} WHERE {rules.earlier_months(*first)}"
+        con.execute(ingest_statement(table, cols, [e["path"] for e in entries], earlier_sql))
+
+        counts = loaded_counts(entries) if not INGEST_CLEAN else dict(
+            ((year, month), n) for year, month, n in query.run(con, f"""
+                SELECT year, month, COUNT(*) FROM {table}
+                WHERE {query.months_in(1)}
+                GROUP BY 1, 2;
+            """, months).fetchall()
+        )
+        for e in entries:
+            record_manifest(con, dataset, e, counts.get((e["year"], e["month"]), 0))
+        if INGEST_CLEAN:
+            record_ingest_clean(con, table, entries, rejects, counts)
+        con.execute("COMMIT;")
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    return sum(counts.values())
+
+
+def replace_lake_partitions(con, taxi, table, cols, entries):
+    # Rewrite the changed months as zstd parquet under lake/raw (lake/clean with INGEST_CLEAN), then record them
+    months = [(e["year"], e["month"]) for e in entries]
+    files = [e["path"] for e in entries]
+    lake.drop_partitions(lake.RAW_LAYER, taxi, months)
+    if INGEST_CLEAN:
+        layer = lake.CLEAN_LAYER
+        lake.drop_partitions(layer, taxi, months)
+        rejects = audit_rejects(con, taxi, cols, files, months)
+        earlier_sql = None
+        if lake.has_files(layer, taxi):
+            earlier_sql = f"SELECT * FROM ({lake.read_sql(layer, taxi)}) WHERE {rules.earlier_months(*min(months))}"
+        lake.write_partitions(con, fused_select(cols, files, taxi, earlier_sql), layer)
+    else:
+        layer = lake.RAW_LAYER
+        lake.write_partitions(con, ingest_select(cols, files, taxi), layer)
+
+    counts = loaded_counts(entries) if not INGEST_CLEAN else {}
+    for e in entries:
+        if INGEST_CLEAN:
+            part = lake.partition_dir(layer, taxi, e["year"], e["month"])
+            counts[(e["year"], e["month"])] = con.execute(f"""
+                SELECT COUNT(*) FROM read_parquet('{part}/*.parquet');
+            """).fetchone()[0] if any(part.glob("*.parquet")) else 0
+        record_manifest(con, taxi, e, counts[(e["year"], e["month"])])
+    if INGEST_CLEAN:
+        record_ingest_clean(con, table, entries, rejects, counts)
+    return sum(counts.values())
+
+
+def loaded_counts(entries):
+    # Without INGEST_CLEAN every row of a month's file lands in that month, so the
+    # catalog's footer row counts are the partition counts and nothing is re-counted
+    return {(e["year"], e["month"]): e["num_rows"] for e in entries}
+
+
+def replace_changed(con, taxi, table, cols, entries):
+    # Returns the number of rows now in the replaced months
+    if STORAGE_MODE == "lake":
+        return replace_lake_partitions(con, taxi, table, cols, entries)
+    return replace_partitions(con, taxi, table, cols, entries)
+
+
+def ingest_per_file(con, dataset, table, cols, entries):
+    failed, rows = [], 0
+    for e in entries:
+        try:
+            with metrics.stage("ingest_file", item=e["path"].name, bytes_read=e["size"]) as m:
+                m["rows_out"] = replace_changed(con, dataset, table, cols, [e])
+            rows += m["rows_out"]
+            logger.info(f"[ingest] OK {e['path'].name}")
+        except Exception as ex:
+            logger.error(f"[ingest] FAIL {e['path'].name}: {ex}")
+            failed.append(e["path"].name)
+    return failed, rows
+
+
+def ingest_taxi(con, taxi, table, cols):
+    # Collect the month files, reporting the ones that are missing or corrupt
+    candidates, missing, corrupt = [], [], []
+    for year in YEARS:
+        for month in MONTHS:
+            fp = DATA_DIR / f'{taxi}_tripdata_{year}-{month}.parquet'
+            if not fp.exists():
+                logger.error(f'[ingest] missing file, skip: {fp.name}')
+                missing.append(fp.name)
+            elif not parquet_file_ok(fp):
+                logger.error(f'[ingest] corrupt file, skip: {fp.name}')
+                corrupt.append(fp.name)
+            else:
+                candidates.append((int(year), int(month), fp))
+
+    # Footer catalog: drifted or unreadable files are rejected before any data page is read
+    with metrics.stage("catalog", item=taxi) as m:
+        cataloged = catalog.refresh(con, taxi, candidates, cols[0], catalog.expected_types(cols, trip_types()))
+        m["rows_out"] = len(cataloged)
+    drifted = []
+    for year, month, fp in candidates:
+        row = cataloged[(year, month)]
+        if row["status"] in ("drift", "unreadable"):
+            logger.error(f"[ingest] {row['status']} file, skip: {fp.name} ({row['problems']})")
+            drifted.append(fp.name)
+    candidates = [c for c in candidates if c[2].name not in drifted]
+
+    # Only months that are new or whose file changed since the last run
+    entries = plan_changes(con, taxi, candidates)
+    for e in entries:
+        e["num_rows"] = cataloged[(e["year"], e["month"])]["num_rows"]
+    planned_rows = sum(e["num_rows"] for e in entries)
+    logger.info(f"[ingest] {taxi}: {len(entries)} of {len(candidates)} files new or changed, {planned_rows} rows")
+    parallel.output(f"[ingest] {taxi}: {len(entries)} of {len(candidates)} files new or changed "
+                    f"({planned_rows:,} rows)")
+
+    # Fused ingest dedupes each batch in memory, so it goes a month at a time like clean.py's partitions
+    failed, rows = [], 0
+    if entries and INGEST_MODE == "bulk" and not INGEST_CLEAN:
+        try:
+            with metrics.stage("ingest_bulk", item=taxi, bytes_read=sum(e["size"] for e in entries)) as m:
+                rows = m["rows_out"] = replace_changed(con, taxi, table, cols, entries)
+            logger.info(f"[ingest] OK {taxi}: {len(entries)} files in one scan")
+        except Exception as e:
+            # Nothing was recorded in the manifest; retry per file to isolate the bad ones
+            logger.error(f"[ingest] bulk FAIL {taxi}, falling back to per-file: {e}")
+            failed, rows = ingest_per_file(con, taxi, table, cols, entries)
+    elif entries:
+        failed, rows = ingest_per_file(con, taxi, table, cols, entries)
+
+    # Lake mode reads the raw layer through a view until clean.py swaps in the clean layer
+    if STORAGE_MODE == "lake":
+        lake.point_view(con, table, lake.CLEAN_LAYER if INGEST_CLEAN else lake.RAW_LAYER, taxi)
+
+    if missing or corrupt or drifted or failed:
+        parallel.output(f"[ingest] {taxi}: {len(missing)} missing, {len(corrupt)} corrupt, "
+                        f"{len(drifted)} rejected by the catalog, {len(failed)} unreadable files (see logs/load.log)")
+    return {"loaded": len(entries) - len(failed), "rows": rows,
+            "missing": missing, "corrupt": corrupt, "drifted": drifted, "failed": failed}
+
+
+def ingest_stage(con, taxi):
+    table = YELLOW_TABLE if taxi == "yellow" else GREEN_TABLE
+    cols = YELLOW_COLS if taxi == "yellow" else GREEN_COLS
+    with metrics.stage("ingest", item=taxi) as m:
+        result = ingest_taxi(con, taxi, table, cols)
+        m["rows_out"] = result["rows"]
+    return result
+
+
+def load_emissions(con):
+    # Small lookup table, reloaded only when the CSV changes
+    entries = plan_changes(con, "emissions", [(0, 0, EMISSIONS_CSV)])
+    if not entries and query.table_exists(con, EMISSIONS_TABLE):
+        logger.info("Emissions CSV unchanged, keeping table")
+        return
+
+    con.execute(f"""
+        CREATE OR REPLACE TABLE {EMISSIONS_TABLE} AS 
+        SELECT * FROM read_csv_auto('{EMISSIONS_CSV}', header = True);
+    """)
+    entry = entries[0] if entries else {"year": 0, "month": 0, "path": EMISSIONS_CSV,
+                                        "size": EMISSIONS_CSV.stat().st_size,
+                                        "mtime": EMISSIONS_CSV.stat().st_mtime,
+                                        "hash": file_hash(EMISSIONS_CSV)}
+    n = con.execute(f"SELECT COUNT(*) FROM {EMISSIONS_TABLE};").fetchone()[0]
+    record_manifest(con, "emissions", entry, n)
+    logger.info("Created emissions table")
 
-        # Connect to local DuckDB instance
-        con = duckdb.connect(database=str(DB_PATH), read_only=False)
-        logger.info("Connected to DuckDB instance")
 
-        # Drop tables if it already exists
-        con.execute(f"""
-            DROP TABLE IF EXISTS {YELLOW_TABLE};
-        """)
-        logger.info("Dropped yellow table if exists")
+# Load function
+# Returns True on success; pass con to reuse an open connection (left open afterwards)
+def load_parquet_files(con=None, download=True):
+    global metrics
+    metrics = instrument.Instrumentation("load")
 
-        con.execute(f"""
-            DROP TABLE IF EXISTS {GREEN_TABLE};
-        """)
-        logger.info("Dropped green table if exists")
+    own_con = con is None
+
+    try:
+        # Download needed parquet files 
+        if download:
+            with metrics.stage("download") as m:
+                results = download_files()
+                m["rows_out"] = sum(1 for r in results.values() if r == "downloaded")
 
-        con.execute(f"""
-            DROP TABLE IF EXISTS {EMISSIONS_TABLE};
-        """)
-        logger.info("Dropped emissions table if exists")
+        # Connect to local DuckDB instance
+        if own_con:
+            con = duckdb.connect(database=str(DB_PATH), read_only=False)
+            logger.info("Connected to DuckDB instance")
+        con = metrics.wrap(con)
+        parallel.configure(con, LOAD_THREADS, LOAD_MEMORY_LIMIT, LOAD_TEMP_DIRECTORY)
 
         print("Creating tables...")
-
-        # Create tables with necessary columns
-        con.execute(f"""
-            CREATE TABLE {YELLOW_TABLE} (
-                tpep_pickup_datetime TIMESTAMP,
-                tpep_dropoff_datetime TIMESTAMP,
-                passenger_count INTEGER,
-                trip_distance DOUBLE
-            );
-        """)
-        logger.info("Created yellow trip table")
-
-        con.execute(f"""
-            CREATE TABLE {GREEN_TABLE} (
-                lpep_pickup_datetime TIMESTAMP,
-                lpep_dropoff_datetime TIMESTAMP,
-                passenger_count INTEGER,
-                trip_distance DOUBLE
-            );
-        """)
-        logger.info("Created green trip table")
-
-        con.execute(f"""
-            CREATE TABLE {EMISSIONS_TABLE} AS 
-            SELECT * FROM read_csv_auto('{EMISSIONS_CSV}', header = True);
-        """)
-        logger.info("Created emissions table")
-
-
-        # Ingest parquet to database 
-        for taxi in TAXIS:
-            table = YELLOW_TABLE if taxi == "yellow" else GREEN_TABLE
-            cols = ", ".join(YELLOW_COLS if taxi =="yellow" else GREEN_COLS)
-
-            for year in YEARS:
-                for month in MONTHS:
-                    fp = DATA_DIR / f'{taxi}_tripdata_{year}-{month}.parquet'
-                    if not fp.exists():
-                        logger.error(f'[ingest] missing file, skip: {fp.name}')
-                        continue
-
-                    try:
-                        con.execute(f"""
-                            INSERT INTO {table}
-                            SELECT {cols}
-                            FROM read_parquet('{fp}');
-                        """)
-                        logger.info(f"[ingest] OK {taxi} {year}-{month}")
-                    except Exception as e: 
-                        logger.error(f"[ingest] FAIL {taxi} {year}-{month}: {e}")
-
-
-        # Get raw counts
-        yellow_count_raw = con.execute(f"""
-                            SELECT COUNT(*) FROM {YELLOW_TABLE};
-                        """).fetchone()[0]
+        with metrics.stage("create_tables"):
+            create_tables(con)
+        with metrics.stage("emissions"):
+            load_emissions(con)
+
+        # Ingest new or changed parquet files to database; taxi types use separate
+        # files and tables, so they ingest side by side
+        parallel.run_parallel(con, {
+            taxi: (lambda cur, taxi=taxi: ingest_stage(cur, taxi)) for taxi in TAXIS
+        }, INGEST_WORKERS, metrics)
+
+
+        # Get raw counts from the footer catalog (rows in the loaded source files) and, after
+        # cleaning at ingest, the manifest (rows kept), without scanning the tables
+        counts = {
+            dataset: (raw, kept) for dataset, raw, kept in con.execute(f"""
+                SELECT m.dataset, COALESCE(SUM(c.num_rows), 0), SUM(m.row_count)
+                FROM {MANIFEST_TABLE} AS m
+                LEFT JOIN {CATALOG_TABLE} AS c USING (dataset, year, month)
+                GROUP BY 1;
+            """).fetchall()
+        }
+        yellow_count_raw, green_count_raw = (
+            counts.get(taxi, (0, 0))[1 if INGEST_CLEAN else 0] for taxi in ("yellow", "green")
+        )
+        emissions_count_raw = counts.get("emissions", (0, 0))[1]
         logger.info(f"[counts] {YELLOW_TABLE}: {yellow_count_raw} rows")
-
-        green_count_raw = con.execute(f"""
-                            SELECT COUNT(*) FROM {GREEN_TABLE};
-                        """).fetchone()[0]
         logger.info(f"[counts] {GREEN_TABLE}: {green_count_raw} rows")
-
-        emissions_count_raw = con.execute(f"""
-                            SELECT COUNT(*) FROM {EMISSIONS_TABLE};
-                        """).fetchone()[0]
         logger.info(f"[counts] {EMISSIONS_TABLE}: {emissions_count_raw} rows")
 
         # Output raw counts
-        print("\nRAW ROW COUNTS BEFORE CLEANING: ")
+        print("\nROW COUNTS AFTER CLEANING AT INGEST: " if INGEST_CLEAN else "\nRAW ROW COUNTS BEFORE CLEANING: ")
         print(f"{YELLOW_TABLE}: {yellow_count_raw}")
         print(f"{GREEN_TABLE}:  {green_count_raw}")
         print(f"{EMISSIONS_TABLE}: {emissions_count_raw}")
 
-        
+        snapshot.record_live_version(con)
+        metrics.finish(con)
+        return True
 
     except Exception as e:
         print(f"An error occurred: {e}")
         logger.error(f"An error occurred: {e}")
+        return False
 
 
     # Close duckdb connection 
     finally:
-        if con is not None:
+        if own_con and con is not None:
             con.close()
             logger.info("Closed DuckDB connection")
 
@@ -0,0 +1,68 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+_worker = threading.local() # .lines: what the current run_parallel worker has printed so far
+_print_lock = threading.Lock()
+
+
+def output(*lines):
+    # print() for code that may run in a run_parallel worker: a worker's lines are held and
+    # printed together when it finishes, so jobs running side by side don't interleave
+    held = getattr(_worker, "lines", None)
+    if held is None:
+        print("\n".join(map(str, lines)))
+    else:
+        held.extend(map(str, lines))
+
+
+def configure(con, threads=None, memory_limit=None, temp_directory=None):
+    # DuckDB settings are per database, so they hold for every cursor of con.
+    # None resets to DuckDB's default, so one stage's settings don't leak into the next on a shared connection.
+    con.execute(f"SET threads = {int(threads)};" if threads else "RESET threads;")
+    con.execute(f"SET memory_limit = '{memory_limit}';" if memory_limit else "RESET memory_limit;")
+    if temp_directory:
+        Path(temp_directory).mkdir(parents=True, exist_ok=True)
+        con.execute(f"SET temp_directory = '{temp_directory}';")
+    else:
+        con.execute("RESET temp_directory;")
+    logger.info(f"[parallel] threads={threads or 'default'} memory_limit={memory_limit or 'default'} "
+                f"temp_directory={temp_directory or 'default'}")
+
+
+def run_parallel(con, jobs, workers, metrics=None):
+    """Runs jobs ({name: fn(con)}) on up to `workers` threads, each with its own cursor of con.
+
+    A cursor is a separate connection to the same database, so each job has its own
+    transactions. Returns {name: result}; the first failing job's error is raised after
+    the others finish. With one worker the jobs run in order on con itself.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return {name: fn(con) for name, fn in jobs.items()}
+
+    parents = metrics.current_stack() if metrics else None
+    parent_lines = getattr(_worker, "lines", None) # set when this runs inside another worker
+
+    def run(fn):
+        cur = con.cursor()
+        if metrics:
+            metrics.adopt(parents)
+        _worker.lines = []
+        try:
+            return fn(cur)
+        finally:
+            cur.close()
+            lines, _worker.lines = _worker.lines, None
+            with _print_lock:
+                if parent_lines is not None:
+                    parent_lines.extend(lines)
+                elif lines:
+                    print("\n".join(lines))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(run, fn) for name, fn in jobs.items()}
+        return {name: fut.result() for name, fut in futures.items()}
@@ -0,0 +1,366 @@
+import duckdb
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable
+
+import analysis
+import clean
+import instrument
+import load
+import query
+import snapshot
+from config import (DB_PATH, DATA_DIR, EMISSIONS_CSV, YEARS, MONTHS, TAXIS, STORAGE_MODE, COMPACT_SCHEMA,
+                    WIDE_TYPES, COMPACT_TYPES, YELLOW_TABLE, GREEN_TABLE, MANIFEST_TABLE, STATS_TABLE, FCT_TRIPS,
+                    CO2_ROLLUP, SKETCH_ACCURACY)
+
+
+# Configs
+STATE_TABLE = "pipeline_state"
+SCRIPTS_DIR = Path(__file__).resolve().parent
+DBT_DIR = Path("dbt")
+DOWNLOAD_MAX_AGE = timedelta(days=1) # re-check the server for newly published months after this long
+
+# Logging (the imported scripts already configured the root logger, so this one gets its own file)
+logger = logging.getLogger(__name__)
+handler = logging.FileHandler('logs/pipeline.log')
+handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logger.addHandler(handler)
+
+
+@dataclass
+class Stage:
+    name: str
+    run: Callable                 # run(pipeline) -> True on success
+    inputs: Callable              # inputs(con) -> JSON-able description of everything the stage reads
+    outputs: Callable             # outputs(con) -> True if the stage's outputs exist
+    deps: list = field(default_factory=list)
+    code: list = field(default_factory=list)  # files whose contents are part of the fingerprint
+    max_age: timedelta = None     # rerun after this long even if the inputs are unchanged
+
+
+# Input descriptions
+def file_stats(paths):
+    return [(p.name, p.stat().st_size, p.stat().st_mtime) for p in sorted(paths) if p.exists()]
+
+
+def code_hash(paths):
+    h = hashlib.sha256()
+    for path in paths:
+        for fp in sorted(path.rglob("*")) if path.is_dir() else [path]:
+            if fp.is_file():
+                h.update(str(fp).encode())
+                h.update(fp.read_bytes())
+    return h.hexdigest()
+
+
+def manifest_rows(con, columns, datasets):
+    # The slice of the ingest manifest a stage depends on
+    if not query.table_exists(con, MANIFEST_TABLE):
+        return []
+    return [list(map(str, row)) for row in query.run(con, f"""
+        SELECT {columns} FROM {MANIFEST_TABLE}
+        WHERE list_contains($1, dataset)
+        ORDER BY ALL;
+    """, [list(datasets)]).fetchall()]
+
+
+def download_inputs(con):
+    return {"url": load.BASE_URL, "taxis": TAXIS, "years": YEARS, "months": MONTHS}
+
+
+def load_inputs(con):
+    # Month files present on disk and the emissions CSV
+    return {
+        "files": file_stats(DATA_DIR.glob("*_tripdata_*.parquet")),
+        "emissions": file_stats([EMISSIONS_CSV]),
+        "years": YEARS,
+        "storage_mode": STORAGE_MODE,
+        "compact_schema": COMPACT_SCHEMA,
+    }
+
+
+def clean_inputs(con):
+    # Only the trip months load.py (re)loaded; an emissions change doesn't need a re-clean
+    return {
+        "months": manifest_rows(con, "dataset, year, month, content_hash, loaded_at", TAXIS),
+        "storage_mode": STORAGE_MODE,
+    }
+
+
+def transform_inputs(con):
+    # Cleaned months, the emissions lookup and the dbt project
+    return {
+        "months": manifest_rows(con, "dataset, year, month, cleaned_at", TAXIS),
+        "emissions": manifest_rows(con, "content_hash, loaded_at", ["emissions"]),
+        "storage_mode": STORAGE_MODE,
+        "compact_schema": COMPACT_SCHEMA,
+        "sketch_accuracy": SKETCH_ACCURACY,
+    }
+
+
+def publish_inputs(con):
+    # A new snapshot whenever dbt rebuilt the models
+    state = stage_state(con).get("transform")
+    return {"transform": state and state["finished_at"]}
+
+
+def analysis_inputs(con):
+    # Whatever the last successful dbt run produced
+    state = stage_state(con).get("transform")
+    return {"transform": state and state["finished_at"]}
+
+
+# Stage bodies
+def run_download(p):
+    # Like load.py, go on with whatever downloaded; failed months are noted in pipeline_state and
+    # retried on the next pipeline run. Only fail when no month file is there at all.
+    results = load.download_files()
+    failed = sorted(name for name, r in results.items() if r == "failed")
+    if failed:
+        p.detail = f"{len(failed)} failed: {', '.join(failed)}"
+    return any(r in ("downloaded", "exists") for r in results.values())
+
+
+def run_load(p):
+    return load.load_parquet_files(p.con, download=False)
+
+
+def run_clean(p):
+    # Months loaded with load.INGEST_CLEAN are already clean; only months loaded raw need clean.py
+    if load.INGEST_CLEAN and query.table_exists(p.con, MANIFEST_TABLE):
+        raw = query.run(p.con, f"""
+            SELECT COUNT(*) FROM {MANIFEST_TABLE} WHERE list_contains($1, dataset) AND cleaned_at IS NULL;
+        """, [TAXIS]).fetchone()[0]
+        if raw == 0:
+            logger.info("[pipeline] clean: every month was cleaned during ingest")
+            return True
+    return clean.clean_tables(p.con)
+
+
+def fct_types_match(con):
+    # An incremental fact table built under the other COMPACT_SCHEMA setting needs a full refresh
+    types = COMPACT_TYPES if COMPACT_SCHEMA else WIDE_TYPES
+    current = dict(query.run(con, """
+        SELECT column_name, data_type FROM information_schema.columns WHERE table_name = $1;
+    """, [FCT_TRIPS]).fetchall())
+    return all(current.get(col, col_type) == col_type for col, col_type in types.items())
+
+
+def rollup_keyed(con):
+    # co2_rollup built as a plain table (before it was incremental) has no source month to replace by
+    columns = {row[0] for row in query.run(con, """
+        SELECT column_name FROM information_schema.columns WHERE table_name = $1;
+    """, [CO2_ROLLUP]).fetchall()}
+    return not columns or {"year", "month"} <= columns
+
+
+def run_transform(p):
+    # dbt is a separate process and DuckDB allows one writer, so the connection is released meanwhile
+    dbt = shutil.which("dbt")
+    if dbt is None:
+        logger.error("[pipeline] dbt not installed")
+        return False
+    full_refresh = ["--full-refresh"] if not (fct_types_match(p.con) and rollup_keyed(p.con)) else []
+    p.close()
+    try:
+        env = dict(os.environ, TAXI_DB_PATH=str(DB_PATH.resolve()))
+        dbt_vars = {"storage_mode": STORAGE_MODE, "compact_schema": COMPACT_SCHEMA,
+                    "sketch_relative_accuracy": SKETCH_ACCURACY}
+        proc = subprocess.run(
+            [dbt, "run", "--project-dir", str(DBT_DIR), "--profiles-dir", str(DBT_DIR),
+             "--vars", json.dumps(dbt_vars)] + full_refresh,
+            env=env, capture_output=True, text=True,
+        )
+        logger.info(f"[pipeline] dbt output:\n{proc.stdout}")
+        if proc.returncode != 0:
+            print(proc.stdout[-2000:])
+        ok = proc.returncode == 0
+    finally:
+        p.connect()
+    if ok:
+        snapshot.record_live_version(p.con)
+    return ok
+
+
+def run_publish(p):
+    # Standalone analysis runs read this read-only copy instead of the working database
+    snapshot.publish(p.con, p.db_path)
+    return True
+
+
+def run_analysis(p):
+    if analysis.analyze_tables(p.con) is None:
+        return False
+    analysis.plot_tables(p.con)
+    return True
+
+
+# Modules the load and clean stages share: the clean rules (applied at ingest too), settings and the query helpers
+SHARED_CODE = [SCRIPTS_DIR / name for name in ("rules.py", "config.py", "query.py", "parallel.py", "lake.py")]
+
+STAGES = [
+    Stage("download", run_download, download_inputs,
+          outputs=lambda con: any(DATA_DIR.glob("*_tripdata_*.parquet")),
+          code=[SCRIPTS_DIR / "load.py"], max_age=DOWNLOAD_MAX_AGE),
+    Stage("load", run_load, load_inputs,
+          outputs=lambda con: query.table_exists(con, YELLOW_TABLE) and query.table_exists(con, GREEN_TABLE),
+          deps=["download"], code=[SCRIPTS_DIR / "load.py", SCRIPTS_DIR / "catalog.py"] + SHARED_CODE),
+    Stage("clean", run_clean, clean_inputs,
+          outputs=lambda con: query.table_exists(con, STATS_TABLE),
+          deps=["load"], code=[SCRIPTS_DIR / "clean.py"] + SHARED_CODE),
+    Stage("transform", run_transform, transform_inputs,
+          outputs=lambda con: query.table_exists(con, FCT_TRIPS),
+          deps=["clean"], code=[DBT_DIR / "models", DBT_DIR / "macros", DBT_DIR / "dbt_project.yml"]),
+    Stage("publish", run_publish, publish_inputs,
+          outputs=lambda con: STORAGE_MODE == "lake" or snapshot.latest_path() is not None,
+          deps=["transform"], code=[SCRIPTS_DIR / "snapshot.py"]),
+    Stage("analysis", run_analysis, analysis_inputs,
+          outputs=lambda con: Path(analysis.PLOT_PATH).exists(),
+          deps=["publish"], code=[SCRIPTS_DIR / name for name in ("analysis.py", "series.py", "result_cache.py",
+                                                                  "query.py", "config.py")]),
+]
+
+
+# State
+def create_state_table(con):
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+            stage VARCHAR PRIMARY KEY,
+            fingerprint VARCHAR,
+            status VARCHAR,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            wall_s DOUBLE,
+            detail VARCHAR
+        );
+    """)
+    con.execute(f"""
+        ALTER TABLE {STATE_TABLE} ADD COLUMN IF NOT EXISTS detail VARCHAR;
+    """)
+
+
+def stage_state(con):
+    if not query.table_exists(con, STATE_TABLE):
+        return {}
+    rows = con.execute(f"SELECT stage, fingerprint, status, finished_at, detail FROM {STATE_TABLE};").fetchall()
+    return {r[0]: {"fingerprint": r[1], "status": r[2], "finished_at": r[3], "detail": r[4]} for r in rows}
+
+
+def record_state(con, stage, fingerprint, status, started_at, wall_s, detail=None):
+    # detail: what went wrong short of failing the stage (e.g. month files that didn't download)
+    con.execute(f"""
+        INSERT OR REPLACE INTO {STATE_TABLE} (stage, fingerprint, status, started_at, finished_at, wall_s, detail)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+    """, [stage, fingerprint, status, started_at, datetime.now(), wall_s, detail])
+
+
+def fingerprint(con, stage):
+    described = json.dumps(stage.inputs(con), sort_keys=True, default=str)
+    return hashlib.sha256((described + code_hash(stage.code)).encode()).hexdigest()
+
+
+def downstream(names):
+    # The named stages plus everything that depends on them
+    out = set(names)
+    for stage in STAGES:
+        if out & set(stage.deps):
+            out.add(stage.name)
+    return out
+
+
+class Pipeline:
+    """Runs STAGES in order, skipping stages whose inputs and code match their last successful run."""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self.con = None
+        self.detail = None # set by a stage body to note problems it got past
+        self.metrics = instrument.Instrumentation("pipeline")
+
+    def connect(self):
+        self.con = duckdb.connect(database=str(self.db_path), read_only=False)
+        create_state_table(self.con)
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    def why_stale(self, stage, fp, state, forced):
+        # Reason to run the stage, or None if it is fresh
+        last = state.get(stage.name)
+        if stage.name in forced:
+            return "forced"
+        if last is None or last["status"] != "ok":
+            return "no successful run"
+        if last["fingerprint"] != fp:
+            return "inputs changed"
+        if not stage.outputs(self.con):
+            return "outputs missing"
+        if last["detail"]:
+            return f"retrying, last run: {last['detail']}"
+        if stage.max_age and datetime.now() - last["finished_at"] > stage.max_age:
+            return "older than max age"
+        return None
+
+    def run(self, force=(), until=None, dry_run=False):
+        forced = downstream(force)
+        self.connect()
+        try:
+            for stage in STAGES:
+                state = stage_state(self.con)
+                fp = fingerprint(self.con, stage)
+                reason = self.why_stale(stage, fp, state, forced)
+                if reason is None:
+                    print(f"[pipeline] {stage.name}: fresh, skipped")
+                    logger.info(f"[pipeline] {stage.name}: fresh, skipped")
+                elif dry_run:
+                    # Later stages can't be judged until this one runs
+                    print(f"[pipeline] {stage.name}: would run ({reason}); later stages depend on it")
+                    break
+                else:
+                    print(f"[pipeline] {stage.name}: running ({reason})")
+                    logger.info(f"[pipeline] {stage.name}: running ({reason})")
+                    started_at, start = datetime.now(), time.perf_counter()
+                    self.detail = None
+                    with self.metrics.stage(stage.name) as m:
+                        ok = stage.run(self)
+                        m["status"] = "ok" if ok else "failed"
+                    record_state(self.con, stage.name, fp if ok else None, "ok" if ok else "failed",
+                                 started_at, round(time.perf_counter() - start, 3), self.detail)
+                    if ok and self.detail:
+                        print(f"[pipeline] {stage.name}: {self.detail}")
+                        logger.warning(f"[pipeline] {stage.name}: {self.detail}")
+                    if not ok:
+                        print(f"[pipeline] {stage.name}: failed, stopping (see logs/)")
+                        logger.error(f"[pipeline] {stage.name}: failed, stopping")
+                        return False
+                if stage.name == until:
+                    break
+            self.metrics.finish(self.con)
+            return True
+        finally:
+            self.close()
+
+
+if __name__ == "__main__":
+    names = [s.name for s in STAGES]
+    parser = argparse.ArgumentParser(description="Run download -> load -> clean -> dbt -> publish -> analysis, skipping fresh stages")
+    parser.add_argument("--force", nargs="+", choices=names, default=[],
+                        help="rerun these stages and everything downstream of them")
+    parser.add_argument("--until", choices=names, help="stop after this stage")
+    parser.add_argument("--dry-run", action="store_true", help="show which stages would run")
+    args = parser.parse_args()
+
+    ok = Pipeline().run(force=args.force, until=args.until, dry_run=args.dry_run)
+    raise SystemExit(0 if ok else 1)
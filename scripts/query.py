@@ -0,0 +1,41 @@
+import re
+
+
+# Parameter binding: validated identifiers for table/column names, and statements run with
+# their values bound to $1, $2, ... placeholders, never formatted into the SQL text. Plans are
+# not reused: DuckDB's Python API has no prepared-statement handle, and EXECUTE of a PREPAREd
+# statement can't take bound values, so every call is parsed and planned again (a few ms next
+# to the scans it plans).
+
+IDENT_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def ident(name):
+    # Table and column names can't be bound, so they are checked before going into the SQL text
+    if not isinstance(name, str) or not IDENT_RE.fullmatch(name):
+        raise ValueError(f"Bad SQL identifier {name!r}")
+    return name
+
+
+def run(con, sql, params=()):
+    """Runs sql with $1, $2, ... bound to params and returns con for fetching.
+
+    DuckDB binds the values itself; lists bind as LIST and dicts as MAP/STRUCT values.
+    """
+    return con.execute(sql, list(params)) if params else con.execute(sql)
+
+
+def table_exists(con, name):
+    # Tables and views alike
+    return run(con, """
+        SELECT COUNT(*) FROM information_schema.tables WHERE table_name = $1;
+    """, [name]).fetchone()[0] > 0
+
+
+def months_in(first):
+    # Predicate for (year, month) pairs bound as two lists at $first and $first + 1 (month_params)
+    return f"(year, month) IN (SELECT UNNEST(${first}::INTEGER[]), UNNEST(${first + 1}::INTEGER[]))"
+
+
+def month_params(months):
+    return [[int(year) for year, _ in months], [int(month) for _, month in months]]
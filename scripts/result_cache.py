@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import os
+import pickle
+import re
+from pathlib import Path
+
+import query
+from config import MANIFEST_TABLE, DBT_RUNS_TABLE
+
+
+# Configs
+CACHE_DIR = Path("cache")
+CACHE_MAX_BYTES = 256 * 1024 * 1024 # least recently used results are evicted above this
+CACHE_ENABLED = True
+
+VERSION_COLUMN = "built_at" # set by dbt on every row it (re)builds; only read when dbt_runs has no record
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(sql):
+    # Whitespace and a trailing semicolon don't change the result; case can (string literals)
+    return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+
+def source_version(con, source):
+    """When the model `source` last changed, from lookups that don't scan it: its newest dbt build
+    (dbt_runs, written by dbt's on-run-end hook) and the ingest manifest. In lake mode the trip
+    models are views over lake/, which load.py and clean.py change without a dbt run."""
+    version = []
+    if query.table_exists(con, MANIFEST_TABLE):
+        version += query.run(con, f"""
+            SELECT COUNT(*), MAX(loaded_at), MAX(cleaned_at) FROM {MANIFEST_TABLE};
+        """).fetchone()
+    built = None
+    if query.table_exists(con, DBT_RUNS_TABLE):
+        built = query.run(con, f"SELECT MAX(finished_at) FROM {DBT_RUNS_TABLE} WHERE model = $1;",
+                          [source]).fetchone()[0]
+    if built is None:
+        # Built before dbt_runs existed: row count plus the newest build time of its rows
+        has_version = query.run(con, """
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_name = $1 AND column_name = $2;
+        """, [source, VERSION_COLUMN]).fetchone()[0] > 0
+        latest = f"MAX({VERSION_COLUMN})" if has_version else "NULL"
+        built = query.run(con, f"SELECT COUNT(*), {latest} FROM {query.ident(source)};").fetchone()
+    return [str(v) for v in version + [built]]
+
+
+def entry_paths(sql, params, versions):
+    # <query hash>_<version hash>.pkl, so older versions of a query are easy to find and drop
+    query_key = hashlib.sha256((normalize(sql) + repr(list(params))).encode()).hexdigest()[:32]
+    version_key = hashlib.sha256(repr(versions).encode()).hexdigest()[:32]
+    return CACHE_DIR / f"{query_key}_{version_key}.pkl", query_key
+
+
+def evict(max_bytes=None):
+    # Drop least recently used entries until the cache fits
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted(CACHE_DIR.glob("*.pkl"), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in entries)
+    for path in entries:
+        if total <= max_bytes:
+            break
+        total -= path.stat().st_size
+        path.unlink(missing_ok=True)
+        logger.info(f"[cache] evicted {path.name}")
+
+
+def clear():
+    for path in CACHE_DIR.glob("*.pkl"):
+        path.unlink(missing_ok=True)
+
+
+def cached(con, sql, sources, fetch="fetchall", params=()):
+    """Runs sql (through query.run, with params bound) and returns result.fetchall(), .df() or
+    .to_arrow_table(), reusing an earlier result while every table in `sources` is unchanged.
+    Results are pickled under CACHE_DIR."""
+    if not CACHE_ENABLED:
+        return getattr(query.run(con, sql, params), fetch)()
+
+    versions = [(source, fetch, source_version(con, source)) for source in sources]
+    path, query_key = entry_paths(sql, params, versions)
+    if path.exists():
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+            os.utime(path)  # mark as recently used
+            logger.info(f"[cache] hit {path.name}")
+            return result
+        except (OSError, pickle.UnpicklingError, EOFError):
+            path.unlink(missing_ok=True)
+
+    result = getattr(query.run(con, sql, params), fetch)()
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(result, f)
+    tmp.replace(path)
+
+    # Results for older versions of the sources can never be hit again
+    for old in CACHE_DIR.glob(f"{query_key}_*.pkl"):
+        if old != path:
+            old.unlink(missing_ok=True)
+    evict()
+    logger.info(f"[cache] miss {path.name}")
+    return result
@@ -0,0 +1,169 @@
+import query
+from config import MANIFEST_TABLE, STATS_TABLE, QUARANTINE_TABLE, TAXI_FOR_TABLE
+
+
+# Cleaning rules shared by clean.py and load.py's fused load-and-clean ingest (INGEST_CLEAN),
+# plus the clean_stats / quarantine bookkeeping both of them write.
+
+RULE_KEYS = ["rows_in", "zero_passengers", "zero_miles", "over_100_miles", "over_one_day", "rows_filtered"]
+
+
+# Filters: remove trips with 0 passengers, 0 miles, >100 miles, >1 day(86400 seconds)
+def clean_filters(pickup_col, dropoff_col):
+    return f"""
+        passenger_count > 0
+        AND trip_distance > 0
+        AND trip_distance <= 100
+        AND date_diff('second', {pickup_col}, {dropoff_col}) <= 86400
+    """
+
+
+def reject_reason(pickup_col, dropoff_col):
+    # First rule a rejected row breaks; "missing_times" when it only fails on NULL timestamps
+    return f"""
+        CASE
+            WHEN NOT coalesce(passenger_count > 0, false) THEN 'zero_passengers'
+            WHEN NOT coalesce(trip_distance > 0, false) THEN 'zero_miles'
+            WHEN trip_distance > 100 THEN 'over_100_miles'
+            WHEN date_diff('second', {pickup_col}, {dropoff_col}) > 86400 THEN 'over_one_day'
+            ELSE 'missing_times'
+        END
+    """
+
+
+# Dedupe: a trip is its times, passengers and distance. source_file, year and month only say which
+# month file it came in, and the same trip can be filed in two of them.
+def trip_key(pickup_col, dropoff_col):
+    return [pickup_col, dropoff_col, "passenger_count", "trip_distance"]
+
+
+def earlier_months(year, month):
+    # Predicate for the (year, month) slices before this one
+    year, month = int(year), int(month)
+    return f"(year < {year} OR (year = {year} AND month < {month}))"
+
+
+def first_copies(source_sql, pickup_col, dropoff_col, earlier_sql=None):
+    """Rows of source_sql (clean ones, with source_file/year/month columns) with each trip once,
+    in trip table column order. The copy kept is the one from the earliest (year, month) file.
+
+    earlier_sql gives the rows of earlier months already in place (query source_sql a slice at a
+    time with earlier_months()); trips found there are dropped, so each slice can be deduped on
+    its own and still match a whole-table dedupe. Only earlier rows picked up within the
+    slice's pickup range are probed, so row groups of other months are mostly skipped.
+    """
+    key = trip_key(pickup_col, dropoff_col)
+    # year * 100 + month orders the month files (one file per month); as fast as DISTINCT *, unlike a min() of a struct
+    sql = f"""
+        SELECT {", ".join(key)},
+            arg_min(source_file, year * 100 + month) AS source_file,
+            min(year * 100 + month) // 100 AS year,
+            min(year * 100 + month) % 100 AS month
+        FROM ({source_sql}) AS src
+        GROUP BY {", ".join(key)}
+    """
+    if earlier_sql:
+        # A row of trip columns is never NULL itself (NULL fields compare as values), so NOT IN is a plain anti join
+        sql += f"""
+        HAVING ({", ".join(key)}) NOT IN (
+            SELECT ({", ".join(key)}) FROM ({earlier_sql}) AS e
+            WHERE {pickup_col} BETWEEN (SELECT MIN({pickup_col}) FROM ({source_sql}))
+                AND (SELECT MAX({pickup_col}) FROM ({source_sql}))
+        )
+        """
+    return sql
+
+
+# Rows each rule rejects (a row can break several), computed in one pass over the raw rows.
+# by_month returns {(year, month): counts} for a source with year/month columns;
+# params are bound to $1, $2, ... in source_sql.
+def rule_counts(con, source_sql, pickup_col, dropoff_col, by_month=False, params=()):
+    group = "year, month," if by_month else ""
+    rows = query.run(con, f"""
+        SELECT
+            {group}
+            COUNT(*),
+            COUNT(*) FILTER (WHERE NOT coalesce(passenger_count > 0, false)),
+            COUNT(*) FILTER (WHERE NOT coalesce(trip_distance > 0, false)),
+            COUNT(*) FILTER (WHERE trip_distance > 100),
+            COUNT(*) FILTER (WHERE date_diff('second', {pickup_col}, {dropoff_col}) > 86400),
+            COUNT(*) FILTER (WHERE NOT coalesce({clean_filters(pickup_col, dropoff_col)}, false))
+        FROM ({source_sql}) AS src
+        {"GROUP BY year, month" if by_month else ""};
+    """, params).fetchall()
+    if by_month:
+        return {(r[0], r[1]): dict(zip(RULE_KEYS, r[2:])) for r in rows}
+    return dict(zip(RULE_KEYS, rows[0]))
+
+
+def create_stats_table(con):
+    # One row per run and cleaned slice (year/month are NULL for a whole-table clean)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {STATS_TABLE} (
+            run_id VARCHAR,
+            table_name VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            rows_in BIGINT,
+            zero_passengers BIGINT,
+            zero_miles BIGINT,
+            over_100_miles BIGINT,
+            over_one_day BIGINT,
+            rows_filtered BIGINT,
+            duplicates_removed BIGINT,
+            rows_out BIGINT,
+            cleaned_at TIMESTAMP
+        );
+    """)
+
+
+def record_stats(con, run_id, table_name, year, month, counts, rows_out):
+    duplicates = counts["rows_in"] - counts["rows_filtered"] - rows_out
+    query.run(con, f"""
+        INSERT INTO {STATS_TABLE} VALUES (
+            $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, now()::TIMESTAMP
+        );
+    """, [run_id, table_name, year, month, *(counts[k] for k in RULE_KEYS), duplicates, rows_out])
+    return counts["rows_in"] - rows_out
+
+
+def mark_cleaned(con, table_name, year=None, month=None):
+    # Without year/month, the whole table was cleaned
+    where, params = ("AND year = $2 AND month = $3", [year, month]) if year is not None else ("", [])
+    query.run(con, f"""
+        UPDATE {MANIFEST_TABLE} SET cleaned_at = now()::TIMESTAMP
+        WHERE dataset = $1 {where};
+    """, [TAXI_FOR_TABLE[table_name], *params])
+
+
+def create_quarantine_table(con):
+    # Rejected rows of both taxi types, with the taxi-specific time columns normalized
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {QUARANTINE_TABLE} (
+            taxi_type VARCHAR,
+            pickup_time TIMESTAMP,
+            dropoff_time TIMESTAMP,
+            passenger_count DOUBLE,
+            trip_distance DOUBLE,
+            source_file VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            reason VARCHAR,
+            rejected_at TIMESTAMP
+        );
+    """)
+
+
+def quarantine(con, taxi, source_sql, pickup_col, dropoff_col, months):
+    # Replace the given months' rejected rows; returns how many rows were kept aside
+    query.run(con, f"""
+        DELETE FROM {QUARANTINE_TABLE}
+        WHERE taxi_type = $1 AND {query.months_in(2)};
+    """, [taxi] + query.month_params(months))
+    return query.run(con, f"""
+        INSERT INTO {QUARANTINE_TABLE}
+        SELECT $1, {pickup_col}, {dropoff_col}, passenger_count, trip_distance,
+            source_file, year, month, {reject_reason(pickup_col, dropoff_col)}, now()::TIMESTAMP
+        FROM ({source_sql}) AS src
+        WHERE NOT coalesce({clean_filters(pickup_col, dropoff_col)}, false);
+    """, [taxi]).fetchone()[0]
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.ticker import FuncFormatter, LogLocator, NullFormatter
+
+import query
+import result_cache
+from config import FCT_TRIPS
+
+
+# Time-series store: CO2 totals and trip counts per taxi type at several grains, computed in one
+# GROUPING SETS scan of the fact model and kept as parquet, so plots never go back to the trips.
+
+# Configs
+SERIES_PATH = Path("series/co2_series.parquet")
+TAXI_STYLES = {"yellow": ("Yellow Taxi", "#FFD700"), "green": ("Green Taxi", "green")}
+
+# Grain -> (period expression over pickup_time, x-axis label, tick format, plot title)
+GRAINS = {
+    "day":   ("CAST(pickup_time AS DATE)", "Date", "%Y-%m-%d", "Daily"),
+    "week":  ("CAST(date_trunc('week', pickup_time) AS DATE)", "Week starting", "%Y-%m-%d", "Weekly"),
+    "month": ("CAST(date_trunc('month', pickup_time) AS DATE)", "Year-Month", "%Y-%m", "Monthly"),
+    "year":  ("CAST(date_trunc('year', pickup_time) AS DATE)", "Year", "%Y", "Yearly"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+def series_sql():
+    # Every grain in one pass; GROUPING() tells the sets apart
+    periods = ",\n            ".join(f"{expr} AS {grain}" for grain, (expr, _, _, _) in GRAINS.items())
+    grain_case = "\n            ".join(f"WHEN GROUPING({grain}) = 0 THEN '{grain}'" for grain in GRAINS)
+    sets = ", ".join(f"(taxi_type, {grain})" for grain in GRAINS)
+    # The pickup filter decides; the source file year only lets the scan prune partitions
+    return f"""
+        SELECT
+            CASE {grain_case} END AS grain,
+            taxi_type,
+            COALESCE({", ".join(GRAINS)}) AS period,
+            SUM(trip_co2_kgs) AS co2_kg,
+            COUNT(*) AS trip_count
+        FROM (
+            SELECT
+            CAST(taxi_type AS VARCHAR) AS taxi_type,
+            trip_co2_kgs,
+            {periods}
+            FROM {FCT_TRIPS}
+            WHERE year BETWEEN $1 AND $2
+            AND EXTRACT(YEAR FROM pickup_time) BETWEEN $3 AND $4
+        ) AS trips
+        GROUP BY GROUPING SETS ({sets})
+        ORDER BY grain, taxi_type, period;
+    """
+
+
+def store_key(con, year_start, year_end):
+    # What the store was built from (the fact model's dbt build and the ingest manifest, see
+    # result_cache.source_version(), plus the query); a stale store is rebuilt
+    return json.dumps({"source": FCT_TRIPS, "version": result_cache.source_version(con, FCT_TRIPS),
+                       "query": hashlib.sha256(result_cache.normalize(series_sql()).encode()).hexdigest()[:16],
+                       "years": [int(year_start), int(year_end)], "grains": list(GRAINS)})
+
+
+def stored_key(path):
+    if not path.exists():
+        return None
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(b"series_key", b"").decode()
+
+
+def build_series(con, year_start, year_end, path=SERIES_PATH, force=False):
+    """Writes the series store (grain, taxi_type, period, co2_kg, trip_count) for the pickup years
+    and returns it as an Arrow table. Skips the scan while the fact model is unchanged."""
+    path = Path(path)
+    key = store_key(con, year_start, year_end)
+    if not force and stored_key(path) == key:
+        logger.info(f"[series] {path} is current, not rescanning {FCT_TRIPS}")
+        return load_series(path)
+
+    series = query.run(con, series_sql(), [int(year_start) - 1, int(year_end) + 1,
+                                           int(year_start), int(year_end)]).to_arrow_table()
+    series = series.replace_schema_metadata({"series_key": key})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(series, tmp)
+    tmp.replace(path)
+    logger.info(f"[series] wrote {series.num_rows} rows for {year_start}-{year_end} to {path}")
+    return series
+
+
+def load_series(path=SERIES_PATH):
+    return pq.read_table(path)
+
+
+def plot_series(series, grain, out_path):
+    # One line per taxi type at one grain, log scale like the original yearly plot
+    if grain not in GRAINS:
+        raise ValueError(f"Unknown grain {grain!r}, expected one of {', '.join(GRAINS)}")
+    _, xlabel, tick_format, title = GRAINS[grain]
+    rows = series.filter(pc.equal(series["grain"], grain))
+    if rows.num_rows == 0:
+        logger.warning(f"[series] no {grain} rows to plot")
+        return
+
+    fig, ax = plt.subplots(figsize=(11, 5))
+    for taxi, (label, color) in TAXI_STYLES.items():
+        taxi_rows = rows.filter(pc.equal(rows["taxi_type"], taxi))
+        ax.plot(taxi_rows["period"].to_numpy(), taxi_rows["co2_kg"].to_numpy(),
+                marker="o" if grain in ("month", "year") else None, label=label, color=color)
+
+    ax.set_yscale("log")
+    ax.yaxis.set_major_locator(LogLocator(base=10, subs=(1.0, 2.0, 5.0), numticks=12))
+    ax.yaxis.set_major_formatter(FuncFormatter(
+        lambda v, _: f"{v/1e6:.1f}M" if v >= 1e6 else f"{v/1e3:.0f}k" if v >= 1e3 else f"{v:.0f}"
+    ))
+    ax.yaxis.set_minor_formatter(NullFormatter())
+
+    # A tick per period when there are few of them, otherwise let matplotlib space them
+    periods = pc.unique(rows["period"]).to_numpy(zero_copy_only=False)
+    if len(periods) <= 36:
+        ax.set_xticks(periods)
+    else:
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+    ax.xaxis.set_major_formatter(mdates.DateFormatter(tick_format))
+    fig.autofmt_xdate()
+
+    # Pickup years covered, from the yearly rows (the first week can start in the previous December)
+    yearly = series.filter(pc.equal(series["grain"], "year"))
+    years = pc.year((yearly if yearly.num_rows else rows)["period"])
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel("Total CO2 (kg, log scale)")
+    ax.set_title(f"{title} Taxi CO2 Totals ({pc.min(years).as_py()}-{pc.max(years).as_py()})")
+    ax.legend()
+    ax.grid(True, which="both", axis="y", alpha=0.3)
+
+    plt.tight_layout()
+    plt.savefig(out_path, dpi=150, bbox_inches="tight")
+    plt.close(fig)
+    logger.info(f"[series] saved {grain} plot: {out_path}")
+    print(f"[Plot] Saved: {out_path}")
+
+
+def render(plots, series=None, path=SERIES_PATH):
+    # plots: {grain: output path}; reads only the series store (or an already loaded series)
+    series = load_series(path) if series is None else series
+    for grain, out_path in plots.items():
+        plot_series(series, grain, out_path)
@@ -0,0 +1,225 @@
+import duckdb
+
+import argparse
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from config import DB_PATH, STORAGE_MODE, MANIFEST_TABLE, DBT_RUNS_TABLE
+
+
+# Published snapshots: the pipeline writes to taxi.duckdb, and readers (analysis, plots) open the
+# latest read-only copy under SNAPSHOT_DIR, so they never wait on the loader's write lock or see a
+# half-finished clean. In lake mode the trips live in parquet files under lake/ that a copy of
+# taxi.duckdb doesn't hold, so nothing is published and readers use the working database.
+
+# Configs
+SNAPSHOT_DIR = Path("snapshots")
+LATEST = SNAPSHOT_DIR / "LATEST" # holds the file name of the newest published snapshot
+LIVE_VERSION = SNAPSHOT_DIR / "LIVE_VERSION" # data version of taxi.duckdb, kept up to date by its writers
+SNAPSHOTS_KEPT = 1 # each is a full copy of taxi.duckdb, so older ones are deleted on publish;
+                   # readers already holding one keep reading it (POSIX)
+OPEN_RETRIES = 3 # a reader can lose the race with garbage collection; it then re-reads LATEST
+CATALOG = DB_PATH.stem # dbt binds its views to "taxi"."main", so snapshots are attached under this name
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_files():
+    # Oldest first; names sort by publish time
+    return sorted(SNAPSHOT_DIR.glob("taxi_*.duckdb"))
+
+
+def latest_path():
+    try:
+        name = LATEST.read_text().strip()
+    except FileNotFoundError:
+        return None
+    path = SNAPSHOT_DIR / name
+    return path if path.exists() else None
+
+
+def sql_path(path):
+    return str(path).replace("'", "''")
+
+
+def open_snapshot(path):
+    # Opened under its own file name the snapshot would be catalog taxi_<timestamp>, and the
+    # dbt views over "taxi"."main" wouldn't bind
+    con = duckdb.connect()
+    try:
+        con.execute(f"ATTACH '{sql_path(path)}' AS {CATALOG} (READ_ONLY);")
+        con.execute(f"USE {CATALOG};")
+    except duckdb.Error:
+        con.close()
+        raise
+    return con
+
+
+def data_version(con):
+    # Newest dbt build, load and clean recorded in con's database; changes whenever the data does
+    tables = {row[0] for row in con.execute("""
+        SELECT table_name FROM duckdb_tables() WHERE database_name = current_database();
+    """).fetchall()}
+    version = []
+    if DBT_RUNS_TABLE in tables:
+        version += con.execute(f"SELECT MAX(finished_at) FROM {DBT_RUNS_TABLE};").fetchone()
+    if MANIFEST_TABLE in tables:
+        version += con.execute(f"SELECT MAX(loaded_at), MAX(cleaned_at) FROM {MANIFEST_TABLE};").fetchone()
+    return [None if v is None else str(v) for v in version]
+
+
+def version_path(path):
+    # Data version a snapshot was published at, next to it
+    return path.with_suffix(".version")
+
+
+def write_version(path, version):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_text(json.dumps(version) + "\n")
+    os.replace(tmp, path)
+
+
+def read_version(path):
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def record_live_version(con):
+    """Records the data version of the database con writes to, for readers of the snapshots.
+
+    Called by the writers (load.py, clean.py, the pipeline after dbt) once their changes are in,
+    so readers can tell a stale snapshot without opening the live database: even a read-only
+    open would lock out the next writer.
+    """
+    if STORAGE_MODE == "lake":
+        return
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    write_version(LIVE_VERSION, data_version(con))
+
+
+def warn_if_stale(path):
+    # Readers don't see load, clean or dbt runs after the snapshot until the next publish
+    published, live = read_version(version_path(path)), read_version(LIVE_VERSION)
+    if published is None or live is None or published == live:
+        return False
+    logger.warning(f"[snapshot] {path.name} is older than {DB_PATH} ({published} < {live})")
+    print(f"[snapshot] WARNING: {path.name} is older than {DB_PATH}; "
+          f"run `python scripts/snapshot.py` (or the pipeline) to publish it")
+    return True
+
+
+def connect_latest():
+    # Read-only connection to the newest snapshot, or None if nothing was published yet
+    if STORAGE_MODE == "lake":
+        return None
+    for _ in range(OPEN_RETRIES):
+        path = latest_path()
+        if path is None:
+            return None
+        try:
+            con = open_snapshot(path)
+        except duckdb.IOException as e:
+            logger.warning(f"[snapshot] couldn't open {path.name}, re-reading {LATEST.name}: {e}")
+            continue
+        warn_if_stale(path)
+        return con
+    return None
+
+
+def check_snapshot(path):
+    # Number of relations in the snapshot; raises if a view doesn't bind
+    con = open_snapshot(path)
+    try:
+        for (view,) in con.execute("""
+            SELECT view_name FROM duckdb_views() WHERE database_name = $1 AND NOT internal;
+        """, [CATALOG]).fetchall():
+            con.execute(f'SELECT * FROM "{view}" LIMIT 0;')
+        return con.execute("""
+            SELECT COUNT(*) FROM information_schema.tables WHERE table_catalog = $1;
+        """, [CATALOG]).fetchone()[0]
+    finally:
+        con.close()
+
+
+def publish(con, db_path=DB_PATH):
+    """Publishes db_path as a new read-only snapshot and returns its path.
+
+    con must be a read-write connection to db_path: holding it keeps other writers out
+    while the checkpointed file is copied, so the copy is consistent. Returns None in lake mode,
+    where the trips aren't in the file.
+    """
+    if STORAGE_MODE == "lake":
+        logger.warning("[snapshot] not publishing: in lake mode the trips are parquet files outside the database")
+        print("[snapshot] lake mode: nothing published, readers use the working database")
+        return None
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    con.execute("CHECKPOINT;")
+
+    name = f"taxi_{datetime.now():%Y%m%d_%H%M%S_%f}.duckdb"
+    tmp = SNAPSHOT_DIR / f".{name}.tmp"
+    shutil.copyfile(db_path, tmp)
+
+    # Check the copy opens the way readers open it, and that its views bind, before anyone is
+    # pointed at it
+    try:
+        tables = check_snapshot(tmp)
+    except duckdb.Error:
+        tmp.unlink()
+        raise
+    tmp.replace(SNAPSHOT_DIR / name)
+    version = data_version(con)
+    write_version(version_path(SNAPSHOT_DIR / name), version)
+    write_version(LIVE_VERSION, version)
+
+    # Swap the pointer in one rename
+    pointer_tmp = LATEST.with_suffix(".tmp")
+    pointer_tmp.write_text(name + "\n")
+    os.replace(pointer_tmp, LATEST)
+    logger.info(f"[snapshot] published {name} ({tables} relations)")
+    print(f"[snapshot] published {SNAPSHOT_DIR / name}")
+
+    collect_garbage()
+    return SNAPSHOT_DIR / name
+
+
+def collect_garbage(kept=None):
+    # Keep the newest `kept` snapshots (and always the one LATEST points at)
+    kept = SNAPSHOTS_KEPT if kept is None else kept
+    latest = latest_path()
+    for path in snapshot_files()[:-kept] if kept else snapshot_files():
+        if path == latest:
+            continue
+        try:
+            path.unlink()
+            version_path(path).unlink(missing_ok=True)
+            logger.info(f"[snapshot] deleted {path.name}")
+        except OSError as e:
+            # e.g. still open by a reader on Windows; the next publish tries again
+            logger.warning(f"[snapshot] couldn't delete {path.name}: {e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish taxi.duckdb as a read-only snapshot for analysis")
+    parser.add_argument("--list", action="store_true", help="list the published snapshots instead")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+        filename='logs/snapshot.log'
+    )
+    if args.list:
+        latest = latest_path()
+        for path in snapshot_files():
+            print(f"{path.name}  {path.stat().st_size / 1e6:.1f} MB{'  (latest)' if path == latest else ''}")
+    else:
+        con = duckdb.connect(database=str(DB_PATH), read_only=False)
+        try:
+            publish(con)
+        finally:
+            con.close()
@@ -0,0 +1,127 @@
+import duckdb
+
+import argparse
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+import instrument
+import query
+from config import DB_PATH, WIDE_TYPES, COMPACT_TYPES, YELLOW_TABLE, GREEN_TABLE, FCT_TRIPS
+
+
+# Configs
+WORK_DIR = Path("bench/work/storage") # one scratch database per schema and table, safe to delete
+RESULTS_DIR = Path("bench/results")
+SCHEMAS = {"wide": WIDE_TYPES, "compact": COMPACT_TYPES}
+REPEATS = 3 # each scan runs this many times, the fastest counts
+
+# Relation -> scans to time: a plain aggregate and a many-group aggregation like analysis.py's
+SCANS = {
+    YELLOW_TABLE: {
+        "sum": "SELECT SUM(trip_distance), SUM(passenger_count) FROM {t}",
+        "group": "SELECT passenger_count, COUNT(*), AVG(trip_distance) FROM {t} GROUP BY ALL",
+    },
+    GREEN_TABLE: {
+        "sum": "SELECT SUM(trip_distance), SUM(passenger_count) FROM {t}",
+        "group": "SELECT passenger_count, COUNT(*), AVG(trip_distance) FROM {t} GROUP BY ALL",
+    },
+    FCT_TRIPS: {
+        "sum": "SELECT SUM(trip_co2_kgs), SUM(trip_distance), MAX(avg_mph) FROM {t}",
+        "group": """SELECT taxi_type, vehicle_type, week_of_year, day_of_week, hour_of_day,
+                    COUNT(*), AVG(trip_co2_kgs), MAX(trip_co2_kgs), SUM(trip_hours)
+                    FROM {t} GROUP BY ALL""",
+    },
+}
+
+
+def copy_relation(source_db, relation, types, out_path):
+    # One table per file, so the file size is that table's storage
+    out_path.unlink(missing_ok=True)
+    con = duckdb.connect(str(out_path))
+    try:
+        con.execute(f"ATTACH '{source_db}' AS src (READ_ONLY);")
+        cols = [c for (c,) in query.run(con, """
+            SELECT column_name FROM duckdb_columns()
+            WHERE database_name = 'src' AND table_name = $1;
+        """, [relation]).fetchall()]
+        casts = ", ".join(f"CAST({c} AS {types[c]}) AS {c}" for c in cols if c in types)
+        replace = f"REPLACE ({casts})" if casts else ""
+        con.execute(f"CREATE TABLE {relation} AS SELECT * {replace} FROM src.{relation};")
+        con.execute("DETACH src;")
+        con.execute("CHECKPOINT;")
+        block_size, used_blocks = con.execute("""
+            SELECT block_size, used_blocks FROM pragma_database_size();
+        """).fetchone()
+        rows = con.execute(f"SELECT COUNT(*) FROM {relation};").fetchone()[0]
+    finally:
+        con.close()
+    return {"rows": rows, "used_bytes": block_size * used_blocks, "file_bytes": out_path.stat().st_size}
+
+
+def time_scans(metrics, relation, schema, path):
+    results = {}
+    con = metrics.wrap(duckdb.connect(str(path), read_only=True))
+    try:
+        for scan, sql in SCANS[relation].items():
+            runs = []
+            for _ in range(REPEATS):
+                with metrics.stage("scan", item=f"{schema} {relation} {scan}") as m:
+                    con.execute(sql.format(t=relation)).fetchall()
+                runs.append(m)
+            best = min(runs, key=lambda r: r["wall_s"])
+            results[scan] = {"wall_s": best["wall_s"], "duckdb_peak_bytes": best["duckdb_peak_bytes"]}
+    finally:
+        con.close()
+    return results
+
+
+def existing_relations(db_path):
+    con = duckdb.connect(str(db_path), read_only=True)
+    try:
+        names = {n for (n,) in con.execute("SELECT table_name FROM information_schema.tables;").fetchall()}
+    finally:
+        con.close()
+    return [r for r in SCANS if r in names]
+
+
+def storage_report(db_path=DB_PATH):
+    """Copies the trip tables and the fact model into the wide and compact schema and
+    compares their storage and scan times. Works on a copy, the database is only read."""
+    metrics = instrument.Instrumentation("storage_report")
+    report = {"database": str(db_path), "started_at": datetime.now().isoformat(timespec="seconds"),
+              "relations": {}}
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    WORK_DIR.mkdir(parents=True, exist_ok=True)
+
+    for relation in existing_relations(db_path):
+        entry = report["relations"][relation] = {}
+        for schema, types in SCHEMAS.items():
+            path = WORK_DIR / f"{schema}_{relation}.duckdb"
+            with metrics.stage("copy", item=f"{schema} {relation}"):
+                entry[schema] = copy_relation(db_path, relation, types, path)
+            entry[schema]["scans"] = time_scans(metrics, relation, schema, path)
+            path.unlink()
+
+        wide, compact = entry["wide"], entry["compact"]
+        print(f"[storage] {relation}: {wide['rows']:,} rows, "
+              f"{wide['used_bytes'] / 1e6:.1f} MB -> {compact['used_bytes'] / 1e6:.1f} MB")
+        for scan in SCANS[relation]:
+            w, c = wide["scans"][scan], compact["scans"][scan]
+            print(f"[storage]   {scan:<6} {w['wall_s']:.3f}s -> {c['wall_s']:.3f}s, "
+                  f"peak {w['duckdb_peak_bytes'] / 1e6:.1f} MB -> {c['duckdb_peak_bytes'] / 1e6:.1f} MB")
+
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    out = RESULTS_DIR / f"storage_{datetime.now():%Y%m%d_%H%M%S}.json"
+    out.write_text(json.dumps(report, indent=2))
+    print(f"[storage] report saved to {out}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare storage and scan time of the wide and compact schemas")
+    parser.add_argument("--db", default=str(DB_PATH), help="database to read (default taxi.duckdb)")
+    args = parser.parse_args()
+
+    storage_report(Path(args.db))
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+# The scripts log to logs/ from import time on and keep cache/, series/ and snapshots/ relative to
+# the working directory, so the tests run in scratch directories
+os.chdir(tempfile.mkdtemp(prefix="taxi_tests_"))
+os.makedirs("logs")
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    (tmp_path / "logs").mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
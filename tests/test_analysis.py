@@ -0,0 +1,40 @@
+import duckdb
+import pytest
+
+import analysis
+
+
+@pytest.fixture
+def con():
+    # A small fct_trips_co2 with the columns the report reads
+    con = duckdb.connect()
+    con.execute("""
+        CREATE TABLE fct_trips_co2 AS
+        SELECT
+            CASE WHEN i % 2 = 0 THEN 'yellow' ELSE 'green' END AS taxi_type,
+            i % 24 AS hour_of_day,
+            i % 7 AS day_of_week,
+            i % 52 + 1 AS week_of_year,
+            i % 12 + 1 AS month_of_year,
+            (i % 97) / 10.0 AS trip_co2_kgs
+        FROM range(20000) AS t(i);
+    """)
+    yield con
+    con.close()
+
+
+@pytest.mark.parametrize("sample", ["2000 ROWS", "10%"])
+def test_sampled_analysis(con, sample, monkeypatch):
+    monkeypatch.setattr(analysis.result_cache, "CACHE_ENABLED", False)
+    results = analysis.analyze_all(con, sample=sample)
+    for result in results.values():
+        assert result.sampled
+        assert set(result.heaviest) == set(analysis.DIMENSIONS)
+
+
+def test_sample_clause():
+    # Only reservoir sampling takes a row count, whatever SAMPLE_METHOD says
+    assert analysis.sample_clause("500 ROWS") == f"USING SAMPLE 500 ROWS (reservoir, {analysis.SAMPLE_SEED})"
+    assert "(bernoulli," in analysis.sample_clause("1%")
+    with pytest.raises(ValueError):
+        analysis.sample_clause("1.5 ROWS")
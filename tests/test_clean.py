@@ -0,0 +1,40 @@
+import duckdb
+import pytest
+
+import clean
+from config import YELLOW_TABLE, YELLOW_COLS
+
+
+@pytest.fixture
+def con():
+    # Two month files: a trip filed in both, a trip repeated within one, and a trip the rules reject
+    con = duckdb.connect()
+    con.execute(f"""
+        CREATE TABLE {YELLOW_TABLE} (
+            tpep_pickup_datetime TIMESTAMP,
+            tpep_dropoff_datetime TIMESTAMP,
+            passenger_count INTEGER,
+            trip_distance DOUBLE,
+            source_file VARCHAR,
+            year INTEGER,
+            month INTEGER
+        );
+        INSERT INTO {YELLOW_TABLE} VALUES
+            ('2024-01-31 23:50', '2024-02-01 00:10', 1, 3.0, 'yellow_tripdata_2024-01.parquet', 2024, 1),
+            ('2024-01-31 23:50', '2024-02-01 00:10', 1, 3.0, 'yellow_tripdata_2024-02.parquet', 2024, 2),
+            ('2024-02-03 10:00', '2024-02-03 10:20', 2, 5.0, 'yellow_tripdata_2024-02.parquet', 2024, 2),
+            ('2024-02-03 10:00', '2024-02-03 10:20', 2, 5.0, 'yellow_tripdata_2024-02.parquet', 2024, 2),
+            ('2024-02-04 10:00', '2024-02-04 10:20', 0, 5.0, 'yellow_tripdata_2024-02.parquet', 2024, 2);
+    """)
+    yield con
+    con.close()
+
+
+@pytest.mark.parametrize("mode", ["partitioned", "full"])
+def test_dedupe_across_month_files(con, mode, monkeypatch):
+    monkeypatch.setattr(clean, "CLEAN_MODE", mode)
+    assert clean.clean_one(con, YELLOW_TABLE, YELLOW_COLS[0], YELLOW_COLS[1]) == 2
+    # The trip filed in January and February stays in January, where it was first filed
+    assert con.execute(f"""
+        SELECT year, month, COUNT(*) FROM {YELLOW_TABLE} GROUP BY ALL ORDER BY ALL;
+    """).fetchall() == [(2024, 1, 1), (2024, 2, 1)]
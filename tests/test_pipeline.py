@@ -0,0 +1,52 @@
+import duckdb
+
+import load
+import pipeline
+
+
+def download_stub(results):
+    def download_files():
+        for name, r in results.items():
+            if r in ("downloaded", "exists"):
+                (pipeline.DATA_DIR / name).parent.mkdir(parents=True, exist_ok=True)
+                (pipeline.DATA_DIR / name).touch()
+        return results
+    return download_files
+
+
+def download_state():
+    con = duckdb.connect(str(pipeline.DB_PATH), read_only=True)
+    try:
+        return con.execute(f"""
+            SELECT status, detail FROM {pipeline.STATE_TABLE} WHERE stage = 'download';
+        """).fetchone()
+    finally:
+        con.close()
+
+
+def test_download_goes_on_past_failed_months(monkeypatch):
+    monkeypatch.setattr(load, "download_files", download_stub({
+        "yellow_tripdata_2024-01.parquet": "downloaded",
+        "yellow_tripdata_2024-02.parquet": "failed",
+    }))
+    assert pipeline.Pipeline().run(until="download")
+    assert download_state() == ("ok", "1 failed: yellow_tripdata_2024-02.parquet")
+
+    # The failed month is retried on the next run
+    p = pipeline.Pipeline()
+    p.connect()
+    try:
+        stage = pipeline.STAGES[0]
+        fp = pipeline.fingerprint(p.con, stage)
+        assert p.why_stale(stage, fp, pipeline.stage_state(p.con), set()).startswith("retrying")
+    finally:
+        p.close()
+
+
+def test_download_fails_when_nothing_downloaded(monkeypatch):
+    monkeypatch.setattr(load, "download_files", download_stub({
+        "yellow_tripdata_2024-01.parquet": "failed",
+        "yellow_tripdata_2024-02.parquet": "missing",
+    }))
+    assert not pipeline.Pipeline().run(until="download")
+    assert download_state()[0] == "failed"
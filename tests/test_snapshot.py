@@ -0,0 +1,60 @@
+import duckdb
+
+import snapshot
+
+
+def build_db(path):
+    # A fact table plus a staging view bound to "taxi"."main", the way dbt creates them
+    con = duckdb.connect(database=str(path))
+    con.execute("""
+        CREATE TABLE fct_trips_co2 AS
+        SELECT CASE WHEN i % 2 = 0 THEN 'yellow' ELSE 'green' END AS taxi_type, i / 10.0 AS trip_co2_kgs
+        FROM range(100) AS t(i);
+    """)
+    con.execute("CREATE VIEW stg_yellow AS SELECT * FROM taxi.main.fct_trips_co2 WHERE taxi_type = 'yellow';")
+    return con
+
+
+def test_view_through_snapshot(workdir):
+    con = build_db(workdir / "taxi.duckdb")
+    try:
+        path = snapshot.publish(con, workdir / "taxi.duckdb")
+    finally:
+        con.close()
+    assert path.name.startswith("taxi_")
+
+    reader = snapshot.connect_latest()
+    try:
+        assert reader.execute("SELECT COUNT(*) FROM stg_yellow;").fetchone()[0] == 50
+    finally:
+        reader.close()
+
+
+def test_no_snapshot_in_lake_mode(workdir, monkeypatch):
+    monkeypatch.setattr(snapshot, "STORAGE_MODE", "lake")
+    con = build_db(workdir / "taxi.duckdb")
+    try:
+        assert snapshot.publish(con, workdir / "taxi.duckdb") is None
+    finally:
+        con.close()
+    assert snapshot.connect_latest() is None
+
+
+def test_stale_snapshot_warns_without_opening_live_db(workdir):
+    con = build_db(workdir / "taxi.duckdb")
+    try:
+        con.execute("CREATE TABLE dbt_runs AS SELECT 'a' AS invocation_id, 'fct_trips_co2' AS model, now() AS finished_at;")
+        path = snapshot.publish(con, workdir / "taxi.duckdb")
+        assert not snapshot.warn_if_stale(path)
+
+        # A later dbt run, recorded by the writer while it still holds taxi.duckdb
+        con.execute("INSERT INTO dbt_runs VALUES ('b', 'fct_trips_co2', now() + INTERVAL 1 SECOND);")
+        snapshot.record_live_version(con)
+        reader = snapshot.connect_latest()
+        try:
+            assert reader.execute("SELECT COUNT(*) FROM stg_yellow;").fetchone()[0] == 50
+        finally:
+            reader.close()
+        assert snapshot.warn_if_stale(path)
+    finally:
+        con.close()